@@ -0,0 +1,230 @@
+'Benchmarks for the QuickBooks synchronization pipeline'
+import sys
+import time
+import datetime
+import subprocess
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def get_peak_memory():
+    'Return peak resident memory of this process in kilobytes if available'
+    if not resource:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_bill_response(recordCount, lineCount=3):
+    'Make a synthetic BillQueryRs response'
+    parts = ['<?xml version="1.0" ?><QBXML><QBXMLMsgsRs><BillQueryRs requestID="1" statusCode="0" statusSeverity="Info" statusMessage="Status OK">']
+    for recordIndex in xrange(recordCount):
+        parts.append('<BillRet><TxnID>%i-1234567890</TxnID><TimeCreated>2011-11-01T10:00:00-05:00</TimeCreated><TimeModified>2011-11-01T10:00:00-05:00</TimeModified><EditSequence>1320159600</EditSequence><TxnNumber>%i</TxnNumber><VendorRef><ListID>80000001-1234567890</ListID><FullName>Hoffmann &amp; Baron</FullName></VendorRef><TxnDate>2011-10-%02i</TxnDate><AmountDue>300.00</AmountDue><IsPaid>false</IsPaid>' % (recordIndex, recordIndex, recordIndex % 28 + 1))
+        for lineIndex in xrange(lineCount):
+            parts.append('<ExpenseLineRet><TxnLineID>%i-%i</TxnLineID><AccountRef><ListID>80000002-1234567890</ListID><FullName>6100 - Patent Related Expenses</FullName></AccountRef><Amount>100.00</Amount><Memo>Inv %i Ref CASE-%i    Filing fees</Memo></ExpenseLineRet>' % (recordIndex, lineIndex, recordIndex, lineIndex))
+        parts.append('</BillRet>')
+    parts.append('</BillQueryRs></QBXMLMsgsRs></QBXML>')
+    return ''.join(parts)
+
+
+def parse_tree(response):
+    'Parse the whole response into a tree before building dictionaries'
+    # Time the C parser that iter_response uses so that the comparison is about streaming
+    try:
+        from xml.etree import cElementTree as xml
+    except ImportError:
+        from xml.etree import ElementTree as xml
+    from quickbooks.qbxml import parse_response_part
+    return [parse_response_part(part) for part in xml.XML(response)[0][0]]
+
+
+def parse_stream(response):
+    'Parse the response one record at a time, keeping only a count'
+    from quickbooks.qbxml import iter_response
+    recordCount = 0
+    for valueByKey in iter_response(response):
+        recordCount += 1
+    return recordCount
+
+
+def parse_records(response):
+    'Parse the response one record at a time into typed records'
+    from quickbooks.qbxml import iter_response
+    from quickbooks.qbschema import decode_response_part
+    return list(iter_response(response, None, decode_response_part))
+
+
+def parse_dictionaries(response):
+    'Parse the response one record at a time into dictionaries'
+    from quickbooks.qbxml import iter_response
+    return list(iter_response(response))
+
+
+def measure_parse(methodName, recordCount):
+    'Measure wall time and peak memory of one parsing method in this process'
+    response = make_bill_response(recordCount)
+    memoryBefore = get_peak_memory()
+    timeBefore = time.time()
+    globals()[methodName](response)
+    return time.time() - timeBefore, get_peak_memory() - memoryBefore
+
+
+def benchmark_parse(recordCount=50000):
+    'Compare response parsers in separate processes'
+    for methodName in 'parse_tree', 'parse_stream', 'parse_dictionaries', 'parse_records':
+        output = subprocess.check_output([sys.executable, __file__, 'measure_parse', methodName, str(recordCount)])
+        seconds, kilobytes = output.split()
+        print '%s: %i records in %.2f seconds, peak memory +%i KB' % (methodName, recordCount, float(seconds), int(kilobytes))
+
+
+def make_inteum_data(count):
+    'Make synthetic Inteum tables and spreadsheet expenses with count patents'
+    lawFirms = [{'id': x, 'name': 'Law Firm %i' % x} for x in xrange(1, max(1, count / 100) + 1)]
+    technologies = [{'id': x, 'case': 'T%06i' % x, 'title': 'Technology %i' % x} for x in xrange(1, max(1, count / 2) + 1)]
+    patentTypes = [{'id': 1, 'name': 'Utility'}, {'id': 2, 'name': 'Provisional'}, {'id': 3, 'name': 'Design'}]
+    countries = [{'id': 1, 'name': 'United States'}, {'id': 2, 'name': 'Canada'}, {'id': 3, 'name': 'Japan'}]
+    patents = []
+    lawFirmExpenses = []
+    for index in xrange(count):
+        patents.append({
+            'id': index + 1,
+            'technologyID': technologies[index % len(technologies)]['id'],
+            'title': 'Patent %i' % index,
+            'lawFirmID': lawFirms[index % len(lawFirms)]['id'],
+            'lawFirmCase': 'LF%06i' % index,
+            'filingDate': '',
+            'serial': '%08i' % index,
+            'statusID': 1,
+            'typeID': patentTypes[index % len(patentTypes)]['id'],
+            'countryID': countries[index % len(countries)]['id'],
+        })
+        lawFirmExpenses.append({
+            'lawFirmID': lawFirms[index % len(lawFirms)]['id'],
+            'lawFirmCase': 'LF%06i' % index,
+            'invoiceDate': datetime.date(2011, index % 12 + 1, index % 28 + 1),
+            'invoiceNumber': 'INV%06i' % index,
+            'invoiceAmount': 100 + index % 1000,
+            'description': 'Filing fees',
+        })
+    return technologies, patents, patentTypes, lawFirms, countries, lawFirmExpenses
+
+
+def measure_sync(count, latency=0):
+    'Synchronize synthetic data into an empty simulator and then again, measuring each stage'
+    from quickbooks import QuickBooks
+    from quickbooks.qbsim import RequestProcessor
+    from quickbooksR import QBRosetta
+    from pipeline import get_stagePacks
+    technologies, patents, patentTypes, lawFirms, countries, lawFirmExpenses = make_inteum_data(count)
+    qbr = QBRosetta(technologies, patents, patentTypes, lawFirms, countries)
+    requestProcessor = RequestProcessor(latency)
+    qb = QuickBooks(requestProcessor=requestProcessor)
+    measurements = []
+    for passName in 'initial', 'repeat':
+        for stageName, candidatePacks, objectType, callbackByKey, requestDictionary, dependencies in get_stagePacks(qbr, technologies, patents, lawFirms, lawFirmExpenses):
+            errors = []
+            callbackByKey.update(
+                show_parse_error=errors.append,
+                show_save_error=lambda pack, error: errors.append(error))
+            requestCountBefore = requestProcessor.requestCount
+            memoryBefore = get_peak_memory()
+            timeBefore = time.time()
+            qb.synchronize(candidatePacks, objectType, callbackByKey, requestDictionary)
+            measurements.append((
+                '%s-%s' % (passName, stageName),
+                time.time() - timeBefore,
+                requestProcessor.requestCount - requestCountBefore,
+                get_peak_memory() - memoryBefore,
+                len(errors)))
+    return measurements
+
+
+def make_jobs(count, countryCount=250):
+    'Make synthetic Inteum tables with many countries and the QuickBooks jobs for their patents'
+    from quickbooksR import QBRosetta
+    technologies, patents, patentTypes, lawFirms, countries, lawFirmExpenses = make_inteum_data(count)
+    countries = [{'id': x + 1, 'name': 'Republic of Country %03i' % x} for x in xrange(countryCount)]
+    for index, patent in enumerate(patents):
+        patent['countryID'] = index % countryCount + 1
+    qbr = QBRosetta(technologies, patents, patentTypes, lawFirms, countries)
+    return qbr, [qbr.format_job(x) for x in patents]
+
+
+def find_country_linear(qbr, countryName):
+    'Look up country by scanning every name as parse_job used to'
+    for country in qbr.countryByID.values():
+        if country['name'].lower().startswith(countryName.lower()):
+            return country
+
+
+def benchmark_parse_job(count=20000):
+    'Compare parse_job throughput with the country prefix index and with a linear scan'
+    qbr, jobs = make_jobs(count)
+    for methodName, get_country_by_name in [
+        ('linear', lambda countryName: find_country_linear(qbr, countryName)),
+        ('prefix', qbr.get_country_by_name),
+    ]:
+        qbr.get_country_by_name = get_country_by_name
+        timeBefore = time.time()
+        for job in jobs:
+            qbr.parse_job(job)
+        seconds = time.time() - timeBefore
+        print '%s: %i jobs in %.2f seconds, %i jobs per second' % (methodName, count, seconds, count / seconds)
+
+
+def make_requestPacks(count):
+    'Make the CustomerAdd and BillAdd requests that the customers and expenses stages send for synthetic data'
+    from quickbooksR import QBRosetta
+    technologies, patents, patentTypes, lawFirms, countries, lawFirmExpenses = make_inteum_data(count)
+    qbr = QBRosetta(technologies, patents, patentTypes, lawFirms, countries)
+    requestPacks = [('CustomerAddRq', {'CustomerAdd': qbr.format_customer(x)}) for x in technologies]
+    requestPacks.extend(('BillAddRq', {'BillAdd': qbr.format_bill(x)}) for x in qbr.collapse_expenses(lawFirmExpenses))
+    return requestPacks
+
+
+def benchmark_format(count=10000, batchSize=100):
+    'Compare the ElementTree and direct request serializers and check that they write the same bytes'
+    from quickbooks import qbxml
+    requestPacks = make_requestPacks(count)
+    batches = [requestPacks[x:x + batchSize] for x in xrange(0, len(requestPacks), batchSize)]
+    for methodNames, format_documents in [
+        (('format_request_tree', 'format_request'), lambda format_request: [
+            format_request(requestType, requestDictionary, '8.0', 'stopOnError') for requestType, requestDictionary in requestPacks]),
+        (('format_batch_request_tree', 'format_batch_request'), lambda format_batch_request: [
+            format_batch_request(x, '8.0', 'continueOnError') for x in batches]),
+    ]:
+        documentsByMethodName = {}
+        for methodName in methodNames:
+            timeBefore = time.time()
+            documentsByMethodName[methodName] = format_documents(getattr(qbxml, methodName))
+            seconds = time.time() - timeBefore
+            print '%s: %i requests in %.2f seconds, %i requests per second' % (methodName, len(requestPacks), seconds, len(requestPacks) / seconds)
+        if documentsByMethodName[methodNames[0]] != documentsByMethodName[methodNames[1]]:
+            print '%s and %s differ' % methodNames
+
+
+def benchmark_sync(*counts):
+    'Run the synchronization stages against the simulator at each scale in separate processes'
+    for count in counts or (1000, 10000, 100000):
+        output = subprocess.check_output([sys.executable, __file__, 'measure_sync', str(count)])
+        for line in output.splitlines():
+            stageName, seconds, requestCount, kilobytes, errorCount = line.split()
+            print '%i %s: %.2f seconds, %s round trips, peak memory +%s KB, %s errors' % (count, stageName, float(seconds), requestCount, kilobytes, errorCount)
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    if arguments and arguments[0] == 'measure_parse':
+        print '%f %i' % measure_parse(arguments[1], int(arguments[2]))
+    elif arguments and arguments[0] == 'measure_sync':
+        for measurement in measure_sync(int(arguments[1]), *[float(x) for x in arguments[2:]]):
+            print '%s %f %i %i %i' % measurement
+    elif arguments and arguments[0] == 'parse_job':
+        benchmark_parse_job(*[int(x) for x in arguments[1:]])
+    elif arguments and arguments[0] == 'sync':
+        benchmark_sync(*[int(x) for x in arguments[1:]])
+    elif arguments and arguments[0] == 'format':
+        benchmark_format(*[int(x) for x in arguments[1:]])
+    else:
+        benchmark_parse(*[int(x) for x in arguments])
@@ -0,0 +1,65 @@
+'Save planned QuickBooks writes as JSON Lines or CSV and load them to write later'
+import csv
+import json
+from collections import OrderedDict
+
+
+# Columns of a change; diff and request are nested, so CSV stores them as JSON text
+COLUMN_NAMES = ['stage', 'objectType', 'requestType', 'diff', 'request', 'error']
+NESTED_COLUMN_NAMES = ['diff', 'request']
+
+
+def make_change(stageName, objectType, requestType=None, diff=None, request=None, error=None):
+    'Return a change that writes request or, given error, records a problem found while planning'
+    return OrderedDict(zip(COLUMN_NAMES, [stageName, objectType, requestType, diff, request, error]))
+
+
+def get_diff(pack, oldPack, objectType):
+    'Return {key: [oldValue, newValue]} for fields that differ between a candidate and the QuickBooks object it matched'
+    diff = OrderedDict()
+    for key in sorted(set(pack) & set(oldPack)):
+        # Skip the raw QuickBooks object
+        if key == objectType:
+            continue
+        if pack[key] != oldPack[key]:
+            diff[key] = [oldPack[key], pack[key]]
+    return diff
+
+
+def save_changes(path, changes):
+    'Write changes to path as CSV if it ends with .csv and as JSON Lines otherwise'
+    changeFile = open(path, 'wb')
+    if path.lower().endswith('.csv'):
+        writer = csv.writer(changeFile)
+        writer.writerow(COLUMN_NAMES)
+        for change in changes:
+            writer.writerow([format_value(change[x]) if x in NESTED_COLUMN_NAMES else change[x] or '' for x in COLUMN_NAMES])
+    else:
+        for change in changes:
+            changeFile.write(format_value(change) + '\n')
+    changeFile.close()
+
+
+def load_changes(path):
+    'Return changes from a file written by save_changes, keeping the order of request fields'
+    changeFile = open(path, 'rb')
+    if path.lower().endswith('.csv'):
+        rows = csv.reader(changeFile)
+        columnNames = next(rows)
+        changes = []
+        for row in rows:
+            valueByKey = dict(zip(columnNames, row))
+            changes.append(make_change(*[parse_value(valueByKey[x]) if x in NESTED_COLUMN_NAMES else valueByKey[x] or None for x in COLUMN_NAMES]))
+    else:
+        changes = [parse_value(x) for x in changeFile if x.strip()]
+    changeFile.close()
+    return changes
+
+
+def format_value(value):
+    # Write dates and other values that JSON lacks as text
+    return json.dumps(value, separators=(',', ':'), default=str)
+
+
+def parse_value(text):
+    return json.loads(text, object_pairs_hook=OrderedDict) if text else None
@@ -1,52 +1,214 @@
 import re
+import os
 import csv
 import datetime
+import multiprocessing
+from itertools import chain
+from collections import OrderedDict
 
 from quickbooksR import QBRosetta
 
 
-class HoffmannAndBaron(QBRosetta):
+# Map expense field to LEDES 1998B column
+COLUMN_NAME_BY_KEY = {
+    'lawFirmCase': 'LAW_FIRM_REFERENCE_NUMBER',
+    'invoiceDate': 'INVOICE_DATE',
+    'invoiceNumber': 'INVOICE_NUMBER',
+    'invoiceAmount': 'INVOICE_AMOUNT',
+    'description': 'DESCRIPTION_OF_EXPENSES',
+}
+# Number of invoices to hold open while reading so that rows of an invoice that are not grouped together still merge
+PENDING_INVOICE_COUNT_MAX = 1000
 
-    lawFirmName = 'Hoffmann & Baron'
-    pattern_lawFirmCase = re.compile(r'OUR DOCKET: (.*)')
+
+class LEDESRosetta(QBRosetta):
+    'Load expenses from LEDES files as described by the class attributes of each law firm'
+
+    lawFirmName = ''
+    # Extract lawFirmCase from the reference column
+    pattern_lawFirmCase = re.compile(r'(.*)')
     pattern_parentheses = re.compile(r'\(.*\)')
+    dateFormat = '%Y%m%d'
+    columnNameByKey = COLUMN_NAME_BY_KEY
+    # Match names of files that belong to this law firm when loading a folder
+    pattern_fileName = None
 
-    def load_expenses(self, csvPath):
-        csvReader = csv.reader(open(csvPath))
-        lawFirmExpenseByInvoiceNumber = {}
+    def load_expenses(self, csvPath, pendingInvoiceCountMax=PENDING_INVOICE_COUNT_MAX):
+        'Yield expenses merged by invoice number while reading the file, keeping the longest description of each invoice'
         lawFirm = self.lawFirmByName[self.lawFirmName.lower()]
-        lawFirmID = lawFirm['id']
-        for row in csvReader:
-            if not row:
-                continue
-            if row[0].startswith('LEDES1998B'):
+        rows = iter_rows(csvPath)
+        indexByKey = dict((key.strip(), index) for index, key in enumerate(next(rows, [])))
+        if not indexByKey:
+            return
+        invoiceNumberIndex = indexByKey[self.columnNameByKey['invoiceNumber']]
+        descriptionIndex = indexByKey[self.columnNameByKey['description']]
+        convert_row = self.make_row_converter(lawFirm['id'], indexByKey)
+        # Hold the invoices seen most recently and yield the one seen least recently when there are too many.
+        # A row of an invoice that was already yielded starts a new expense, which drop_repeated_invoices removes.
+        pendingExpenseByInvoiceNumber = OrderedDict()
+        lawFirmExpense = None
+        for row in rows:
+            invoiceNumber = row[invoiceNumberIndex].strip()
+            # Rows of an invoice are usually grouped together
+            if lawFirmExpense and invoiceNumber == lawFirmExpense['invoiceNumber']:
+                pass
+            elif invoiceNumber in pendingExpenseByInvoiceNumber:
+                lawFirmExpense = pendingExpenseByInvoiceNumber.pop(invoiceNumber)
+                pendingExpenseByInvoiceNumber[invoiceNumber] = lawFirmExpense
+            else:
+                lawFirmExpense = pendingExpenseByInvoiceNumber[invoiceNumber] = convert_row(row)
+                if len(pendingExpenseByInvoiceNumber) > pendingInvoiceCountMax:
+                    yield pendingExpenseByInvoiceNumber.popitem(last=False)[1]
                 continue
-            if '\t' in row[0]:
-                row = row[0].split('\t')
-            if 'INVOICE_AMOUNT' in row:
-                indexByKey = dict((key.strip(), index) for index, key in enumerate(row))
-                continue
-            lawFirmCase = self.pattern_lawFirmCase.match(row[indexByKey['LAW_FIRM_REFERENCE_NUMBER']]).group(1)
-            lawFirmCase = self.pattern_parentheses.sub('', lawFirmCase).strip()
-            invoiceDate = datetime.datetime.strptime(row[indexByKey['INVOICE_DATE']], '%Y%m%d').date()
-            invoiceNumber = row[indexByKey['INVOICE_NUMBER']].strip()
-            invoiceAmount = float(row[indexByKey['INVOICE_AMOUNT']])
-            description = row[indexByKey['DESCRIPTION_OF_EXPENSES']].strip('" ')
-            if invoiceNumber not in lawFirmExpenseByInvoiceNumber:
-                lawFirmExpenseByInvoiceNumber[invoiceNumber] = {
-                    'lawFirmID': lawFirmID,
-                    'lawFirmCase': lawFirmCase,
-                    'invoiceDate': invoiceDate,
-                    'invoiceNumber': invoiceNumber,
-                    'invoiceAmount': invoiceAmount,
-                    'description': description,
-                }
-            elif len(description) > len(lawFirmExpenseByInvoiceNumber[invoiceNumber]['description']):
+            description = row[descriptionIndex].strip('" ')
+            if len(description) > len(lawFirmExpense['description']):
                 # Store the longer description
-                lawFirmExpenseByInvoiceNumber[invoiceNumber]['description'] = description
-        return lawFirmExpenseByInvoiceNumber.values()
+                lawFirmExpense['description'] = description
+        for lawFirmExpense in pendingExpenseByInvoiceNumber.itervalues():
+            yield lawFirmExpense
+
+    def make_row_converter(self, lawFirmID, indexByKey):
+        'Return a function that converts the first row of an invoice into an expense'
+        lawFirmCaseIndex, invoiceDateIndex, invoiceNumberIndex, invoiceAmountIndex, descriptionIndex = [indexByKey[self.columnNameByKey[x]] for x in [
+            'lawFirmCase',
+            'invoiceDate',
+            'invoiceNumber',
+            'invoiceAmount',
+            'description',
+        ]]
+        match_lawFirmCase = self.pattern_lawFirmCase.match
+        remove_parentheses = self.pattern_parentheses.sub
+        dateFormat = self.dateFormat
+        strptime = datetime.datetime.strptime
+        # Invoices in one file share few dates, so parse each date once
+        dateByText = {}
+
+        def convert_row(row):
+            invoiceDateText = row[invoiceDateIndex]
+            try:
+                invoiceDate = dateByText[invoiceDateText]
+            except KeyError:
+                invoiceDate = dateByText[invoiceDateText] = strptime(invoiceDateText, dateFormat).date()
+            return {
+                'lawFirmID': lawFirmID,
+                'lawFirmCase': remove_parentheses('', match_lawFirmCase(row[lawFirmCaseIndex]).group(1)).strip(),
+                'invoiceDate': invoiceDate,
+                'invoiceNumber': row[invoiceNumberIndex].strip(),
+                'invoiceAmount': float(row[invoiceAmountIndex]),
+                'description': row[descriptionIndex].strip('" '),
+            }
+        return convert_row
+
+
+def make_module(className, lawFirmName, lawFirmCasePattern, dateFormat='%Y%m%d', columnNameByKey=None, fileNamePattern=None):
+    'Return a LEDESRosetta subclass for a law firm'
+    return type(className, (LEDESRosetta,), {
+        'lawFirmName': lawFirmName,
+        'pattern_lawFirmCase': re.compile(lawFirmCasePattern),
+        'dateFormat': dateFormat,
+        'columnNameByKey': dict(COLUMN_NAME_BY_KEY, **(columnNameByKey or {})),
+        'pattern_fileName': re.compile(fileNamePattern, re.IGNORECASE) if fileNamePattern else None,
+        '__module__': __name__,
+    })
+
+
+def iter_rows(csvPath):
+    'Yield rows of a LEDES 1998B or delimited text file, detecting the delimiter from the header'
+    csvFile = open(csvPath, 'rU')
+    try:
+        for line in csvFile:
+            if line.strip() and not line.startswith('LEDES1998B'):
+                break
+        else:
+            return
+        if '|' in line:
+            delimiter = '|'
+        elif '\t' in line:
+            delimiter = '\t'
+        else:
+            delimiter = ','
+        lines = chain([line], csvFile)
+        if delimiter == '|':
+            rows = (x.rstrip().split('|') for x in lines if x.strip())
+        else:
+            rows = (x for x in csv.reader(lines, delimiter=delimiter) if x)
+        for row in rows:
+            # LEDES 1998B lines end with []
+            if row[-1].endswith('[]'):
+                row[-1] = row[-1][:-2]
+            yield row
+    finally:
+        csvFile.close()
+
+
+def drop_repeated_invoices(lawFirmExpenses):
+    'Yield the first expense of each invoice of each law firm, dropping copies from later rows or overlapping files'
+    invoiceKeys = set()
+    for lawFirmExpense in lawFirmExpenses:
+        invoiceKey = lawFirmExpense['lawFirmID'], lawFirmExpense['invoiceNumber']
+        if invoiceKey in invoiceKeys:
+            continue
+        invoiceKeys.add(invoiceKey)
+        yield lawFirmExpense
+
+
+def find_pathPacks(folderPath):
+    'Return (module, path) for each file in the folder that matches the fileNamePattern of a module'
+    pathPacks = []
+    for fileName in sorted(os.listdir(folderPath)):
+        module = find_module(fileName)
+        if module:
+            pathPacks.append((module, os.path.join(folderPath, fileName)))
+    return pathPacks
+
+
+def find_module(fileName):
+    'Return the first module whose fileNamePattern matches fileName'
+    for module in modules:
+        if module.pattern_fileName and module.pattern_fileName.search(fileName):
+            return module
+
+
+def load_folder(pathPacks, inteumTables, processCount=None):
+    'Yield expenses from (module, path) pairs, loading files in parallel worker processes'
+    taskPacks = [(module.__name__, path) for module, path in pathPacks]
+    if processCount == 1 or len(taskPacks) < 2:
+        initialize_worker(inteumTables)
+        pool = None
+        lawFirmExpenseLists = (load_file(x) for x in taskPacks)
+    else:
+        pool = multiprocessing.Pool(processCount, initialize_worker, (inteumTables,))
+        # Take the files in the order of pathPacks so that the same file wins on every run where exports overlap
+        lawFirmExpenseLists = pool.imap(load_file, taskPacks)
+    try:
+        for lawFirmExpense in drop_repeated_invoices(chain.from_iterable(lawFirmExpenseLists)):
+            yield lawFirmExpense
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def initialize_worker(inteumTables):
+    'Store (technologies, patents, patentTypes, lawFirms, countries) once per worker process'
+    global workerInteumTables, workerRosettaByModuleName # Used by load_file
+    workerInteumTables = inteumTables
+    workerRosettaByModuleName = {}
+
+
+def load_file(taskPack):
+    'Load all expenses from one file in a worker process'
+    moduleName, path = taskPack
+    try:
+        qbr = workerRosettaByModuleName[moduleName]
+    except KeyError:
+        qbr = workerRosettaByModuleName[moduleName] = moduleByName[moduleName](*workerInteumTables)
+    return list(qbr.load_expenses(path))
+
+
+HoffmannAndBaron = make_module('HoffmannAndBaron', 'Hoffmann & Baron', r'OUR DOCKET: (.*)', fileNamePattern=r'hoffmann|baron')
 
 
 modules = [
     HoffmannAndBaron,
 ]
+moduleByName = dict((x.__name__, x) for x in modules)
@@ -1,13 +1,18 @@
 import os
 import wx
+import time
 import traceback
-from collections import OrderedDict
 from threading import Thread
 
-from csvI import modules
+from csvI import modules, find_pathPacks
 from parameters import *
-from quickbooks import QuickBooks
-from inteumI import Inteum
+from progress import ProgressQueue
+
+
+# Milliseconds between updates of the text and gauges from the synchronization thread
+PROGRESS_INTERVAL_MILLISECONDS = 200
+# Counts that show the rate of a task, in order of preference
+RATE_KEYS = ['writtenCount', 'matchedCount', 'count']
 
 
 welcomeText = """\
@@ -25,11 +30,26 @@ class MainFrame(wx.Frame):
         wx.Frame.__init__(self, parent, title=title)
         self.textCtrl = wx.TextCtrl(self, style=wx.TE_MULTILINE | wx.TE_READONLY)
         self.textCtrl.SetValue(welcomeText)
+        # Add a gauge for each task as the synchronization thread reports it
+        self.progressSizer = wx.FlexGridSizer(0, 3, 4, 10)
+        self.progressSizer.AddGrowableCol(1)
+        self.progressPackByStageName = {}
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(self.progressSizer, 0, wx.EXPAND | wx.ALL, 5)
+        sizer.Add(self.textCtrl, 1, wx.EXPAND)
+        self.SetSizer(sizer)
         self.Show(True)
         self.CreateStatusBar()
 
+        # The synchronization thread posts to progressQueue and the timer draws its events in batches
+        self.progressQueue = ProgressQueue()
+        self.progressTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_progressTimer, self.progressTimer)
+
         fileMenu = wx.Menu()
         self.fileOpen = fileMenu.Append(wx.ID_OPEN, '&Open', 'Import law firm expenses into QuickBooks')
+        self.fileOpenFolder = fileMenu.Append(wx.ID_ANY, 'Open &Folder', 'Import expenses from every law firm spreadsheet in a folder')
+        self.fileFullScan = fileMenu.AppendCheckItem(wx.ID_ANY, 'Full &Scan', 'Query every record instead of those changed since the last import, to catch records that were deleted or merged')
         self.fileExit = fileMenu.Append(wx.ID_EXIT, 'E&xit', 'Terminate the program')
 
         menuBar = wx.MenuBar()
@@ -37,6 +57,7 @@ class MainFrame(wx.Frame):
         self.SetMenuBar(menuBar)
 
         self.Bind(wx.EVT_MENU, self.on_fileOpen, self.fileOpen)
+        self.Bind(wx.EVT_MENU, self.on_fileOpenFolder, self.fileOpenFolder)
         self.Bind(wx.EVT_MENU, self.on_fileExit, self.fileExit)
 
         self.Show(True)
@@ -50,28 +71,84 @@ class MainFrame(wx.Frame):
             self.textCtrl.SetValue('Choose the law firm corresponding to the spreadsheet.')
             lawFirmDialog = LawFirmDialog(None, 'Choose law firm')
             if lawFirmDialog.ShowModal() == wx.ID_OK:
-                self.textCtrl.Clear()
-                self.fileOpen.Enable(False)
-                CoreThread(
-                    lawFirmDialog.selectedModule, 
-                    filePath, 
-                    self.textCtrl.AppendText,
-                    self.on_taskEnd,
-                ).start()
+                self.start_task(lawFirmDialog.selectedModule, filePath)
             else:
                 self.textCtrl.SetValue(welcomeText)
             lawFirmDialog.Destroy()
         fileDialog.Destroy()
 
+    def on_fileOpenFolder(self, e):
+        folderDialog = wx.DirDialog(self, 'Choose folder of spreadsheets')
+        if folderDialog.ShowModal() == wx.ID_OK:
+            self.start_task(None, folderDialog.GetPath())
+        folderDialog.Destroy()
+
     def on_fileExit(self, e):
         self.Close(True)
 
+    def start_task(self, module, filePath):
+        self.textCtrl.Clear()
+        self.fileOpen.Enable(False)
+        self.fileOpenFolder.Enable(False)
+        self.progressSizer.Clear(deleteWindows=True)
+        self.progressPackByStageName = {}
+        self.progressQueue.clear()
+        self.progressTimer.Start(PROGRESS_INTERVAL_MILLISECONDS)
+        CoreThread(
+            module,
+            filePath,
+            self.progressQueue.show_text,
+            # Call on_taskEnd from the window thread
+            lambda isOk: wx.CallAfter(self.on_taskEnd, isOk),
+            self.progressQueue.show_progress,
+            self.fileFullScan.IsChecked(),
+        ).start()
+
+    def on_progressTimer(self, e):
+        text, valueByKeyByStageName = self.progressQueue.drain()
+        if text:
+            self.textCtrl.AppendText(text)
+        for stageName, valueByKey in valueByKeyByStageName.iteritems():
+            self.show_progress(stageName, valueByKey)
+
+    def show_progress(self, stageName, valueByKey):
+        'Update the gauge and counts of a task, adding them if the task is new'
+        try:
+            gauge, countText, oldValueByKey, timeStart = self.progressPackByStageName[stageName]
+        except KeyError:
+            gauge = wx.Gauge(self, range=100, size=(200, 15))
+            countText = wx.StaticText(self)
+            oldValueByKey, timeStart = {}, time.time()
+            self.progressSizer.Add(wx.StaticText(self, label=stageName), 0, wx.ALIGN_CENTER_VERTICAL)
+            self.progressSizer.Add(gauge, 1, wx.EXPAND)
+            self.progressSizer.Add(countText, 0, wx.ALIGN_CENTER_VERTICAL)
+            self.progressPackByStageName[stageName] = gauge, countText, oldValueByKey, timeStart
+            self.Layout()
+        oldValueByKey.update(valueByKey)
+        # The number of records is not known in advance, so pulse until the task is done
+        if oldValueByKey.get('status') == 'done':
+            gauge.SetValue(gauge.GetRange())
+            seconds = oldValueByKey.get('seconds') or 0
+        else:
+            gauge.Pulse()
+            seconds = time.time() - timeStart
+        countTexts = ['%s %s' % (x[:-len('Count')] if x.endswith('Count') else x, y) for x, y in sorted(oldValueByKey.items()) if x.lower().endswith('count')]
+        rateCount = ([oldValueByKey[x] for x in RATE_KEYS if oldValueByKey.get(x)] or [0])[0]
+        if rateCount and seconds:
+            countTexts.append('%i per second' % (rateCount / seconds))
+        countText.SetLabel(', '.join(countTexts))
+
     def on_taskEnd(self, isOk):
+        self.progressTimer.Stop()
+        # The thread posts everything before it ends, which can take more than one drain to show
+        while not self.progressQueue.empty():
+            self.on_progressTimer(None)
         if isOk:
             wx.MessageBox('Done.', 'Update complete')
         else:
             wx.MessageBox('Errors found', 'Update failed')
         self.fileOpen.Enable(True)
+        self.fileOpenFolder.Enable(True)
 
 
 class LawFirmDialog(wx.Dialog):
@@ -118,12 +195,14 @@ class LawFirmDialog(wx.Dialog):
 
 class CoreThread(Thread):
 
-    def __init__(self, module, filePath, show_text, signal_end):
+    def __init__(self, module, filePath, show_text, signal_end, show_progress=None, fullScan=False):
         super(CoreThread, self).__init__()
         self.module = module
         self.filePath = filePath
         self.show_text = show_text
         self.signal_end = signal_end
+        self.show_progress = show_progress or (lambda stageName, valueByKey: None)
+        self.fullScan = fullScan
 
     def summarize_candidatePacks(self, packs):
         packCount = len(packs)
@@ -140,6 +219,9 @@ class CoreThread(Thread):
     def show_error(self, error):
         self.show_text('%s\n' % error)
 
+    def show_save_error(self, pack, error):
+        self.show_text('Could not save %s: %s\n' % (pack, error))
+
     def prompt_update(self, pack, oldPack):
         self.show_text('\nMismatch:\n')
         self.show_text(str(pack) + '\n')
@@ -151,132 +233,35 @@ class CoreThread(Thread):
         return True
 
     def run(self):
-        # try:
-        self.show_text('Connecting to Inteum... ')
-        inteum = Inteum(INTEUM_DSN)
-        self.show_text('OK\n')
-
-        self.show_text('Loading technologies... ')
-        technologies = inteum.get_technologies()
-        self.show_text('%s\n' % len(technologies))
-
-        self.show_text('Loading patents... ')
-        patents = inteum.get_patents()
-        self.show_text('%s\n' % len(patents))
-
-        self.show_text('Loading patentTypes... ')
-        patentTypes = inteum.get_patentTypes()
-        self.show_text('%s\n' % len(patentTypes))
-
-        self.show_text('Loading lawFirms... ')
-        lawFirms = inteum.get_lawFirms()
-        self.show_text('%s\n' % len(lawFirms))
-
-        self.show_text('Loading countries... ')
-        countries = inteum.get_countries()
-        self.show_text('%s\n' % len(countries))
-
-        self.show_text('Loading expenses from spreadsheet... ')
-        qbr = self.module(technologies, patents, patentTypes, lawFirms, countries)
-        lawFirmExpenses = qbr.load_expenses(self.filePath)
-        self.show_text('%s\n' % len(lawFirmExpenses))
-
-        self.show_text('Connecting to QuickBooks... ')
-        qb = QuickBooks(applicationName=QUICKBOOKS_APPLICATION_NAME)
-        self.show_text('OK\n')
-
-        self.show_text('Updating vendors in QuickBooks using lawFirms from Inteum...\n')
-        qb.synchronize(lawFirms, 'Vendor', dict(
-            equal=qbr.equal_lawFirm,
-            parse_result=qbr.parse_vendor,
-            update_result=qbr.format_vendor,
-            format_result=qbr.format_vendor,
-            # expand_results=
-            # collapse_packs=
-            prompt_update=self.prompt_update,
-            prompt_save=self.prompt_save,
-            show_parse_error=self.show_error,
-            show_format_error=self.show_error,
-            summarize_candidatePacks=self.summarize_candidatePacks,
-            summarize_mismatches=self.summarize_mismatches,
-            summarize_newPacks=self.summarize_newPacks,
-        ))
-
-        self.show_text('Updating customers in QuickBooks using technologies from Inteum...\n')
-        qb.synchronize(technologies, 'Customer', dict(
-            equal=qbr.equal_technology,
-            parse_result=qbr.parse_customer,
-            update_result=qbr.format_customer,
-            format_result=qbr.format_customer,
-            # expand_results=
-            # collapse_packs=
-            prompt_update=self.prompt_update,
-            prompt_save=self.prompt_save,
-            show_parse_error=self.show_error,
-            show_format_error=self.show_error,
-            summarize_candidatePacks=self.summarize_candidatePacks,
-            summarize_mismatches=self.summarize_mismatches,
-            summarize_newPacks=self.summarize_newPacks,
-        ))
-
-        self.show_text('Updating jobs in QuickBooks using patents from Inteum...\n')
-        qb.synchronize(patents, 'Customer', dict(
-            equal=qbr.equal_patent,
-            parse_result=qbr.parse_job,
-            update_result=qbr.format_job,
-            format_result=qbr.format_job,
-            # expand_results=
-            # collapse_packs=
+        # Import the database and COM machinery after the window is up
+        from pipeline import Pipeline
+        if os.path.isdir(self.filePath):
+            pathPacks = find_pathPacks(self.filePath)
+            self.show_text('Found %i spreadsheets\n' % len(pathPacks))
+        else:
+            pathPacks = [(self.module, self.filePath)]
+        pipeline = Pipeline(dict(
+            show_text=self.show_text,
+            show_progress=self.show_progress,
             prompt_update=self.prompt_update,
             prompt_save=self.prompt_save,
             show_parse_error=self.show_error,
             show_format_error=self.show_error,
+            show_save_error=self.show_save_error,
             summarize_candidatePacks=self.summarize_candidatePacks,
             summarize_mismatches=self.summarize_mismatches,
             summarize_newPacks=self.summarize_newPacks,
         ))
-
-        self.show_text('Updating expense accounts in QuickBooks...\n')
-        qb.synchronize([{'name': '6100 - Patent Related Expenses'}], 'Account', dict(
-            equal=lambda account1, account2: account1['name'].lower() == account2['name'].lower(),
-            parse_result=lambda result: {'name': result['FullName']},
-            # update_result=,
-            format_result=lambda account, show_format_error: OrderedDict([('Name', account['name']), ('AccountType', 'Expense')]),
-            # expand_results=,
-            # collapse_packs=,
-            # prompt_update=,
-            prompt_save=self.prompt_save,
-            show_parse_error=self.show_error,
-            show_format_error=self.show_error,
-            summarize_candidatePacks=self.summarize_candidatePacks,
-            summarize_mismatches=self.summarize_mismatches,
-            summarize_newPacks=self.summarize_newPacks,
-        ))
-
-        self.show_text('Updating expenses in QuickBooks using expenses from spreadsheet...\n')
-        qb.synchronize(lawFirmExpenses, 'Bill', dict(
-            equal=qbr.equal_expense,
-            parse_result=qbr.parse_bill,
-            update_result=qbr.update_bill,
-            format_result=qbr.format_bill,
-            expand_results=qbr.expand_bills,
-            collapse_packs=qbr.collapse_expenses,
-            prompt_update=self.prompt_update,
-            prompt_save=self.prompt_save,
-            show_parse_error=self.show_error,
-            show_format_error=self.show_error,
-            summarize_candidatePacks=self.summarize_candidatePacks,
-            summarize_mismatches=self.summarize_mismatches,
-            summarize_newPacks=self.summarize_newPacks,
-        ), {'IncludeLineItems': 1})
-
-        # except Exception, error:
-            # self.show_text('\n' + traceback.format_exc() + '\n')
-            # self.show_text('Failed.')
-            # self.signal_end(isOk=False)
-        # else:
-            # self.show_text('Done.')
-            # self.signal_end(isOk=True)
+        # signal_end returns to the window thread, so the window can report failures
+        try:
+            pipeline.run(pathPacks, fullScan=self.fullScan)
+        except Exception, error:
+            self.show_text('\n' + traceback.format_exc() + '\n')
+            self.show_text('Failed.')
+            self.signal_end(isOk=False)
+        else:
+            self.show_text('Done.')
+            self.signal_end(isOk=True)
 
 
 if __name__ == '__main__':
@@ -1,22 +1,62 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.declarative import declarative_base
+import os
+import cPickle as pickle
+from threading import Lock
+
+
+# Reflect only the tables that we use
+TABLE_NAMES = ['TECHNOL', 'PATENTS', 'PAPPTYPE', 'COMPANY', 'COUNTRY', 'PAYABLE', 'PAYBLDTL']
 
 
 class Inteum(object):
 
-    def __init__(self, dsn):
-        engine = create_engine('mssql+pyodbc://' + dsn)
-        self.Base = declarative_base()
-        self.Base.metadata.reflect(engine)
-        self.db = sessionmaker(engine)()
-        self.tables = self.Base.metadata.tables
+    def __init__(self, dsn, timestampColumnName=None, fetchSize=1000, metadataCachePath=None):
+        # Import SQLAlchemy only when we connect to Inteum
+        from sqlalchemy import create_engine
+        self.engine = create_engine('mssql+pyodbc://' + dsn)
+        self.timestampColumnName = timestampColumnName
+        self.fetchSize = fetchSize
+        self.metadataCachePath = metadataCachePath
+        self._tables = None
+        self._tablesLock = Lock()
+
+    @property
+    def tables(self):
+        'Reflect tables on first access'
+        # Loaders may run in parallel threads, so only the first one reflects
+        with self._tablesLock:
+            if self._tables is None:
+                self._tables = reflect_tables(self.engine, TABLE_NAMES, self.metadataCachePath)
+        return self._tables
 
-    def get_technologies(self):
-        class Technology(self.Base):
-            __table__ = self.tables['TECHNOL']
+    def get_timestamp(self):
+        'Return the current time on the database server'
+        from sqlalchemy import select, func
+        return self.engine.execute(select([func.current_timestamp()])).scalar()
+
+    def select(self, table, columnNames, fromModifiedDate=None, whereclause=None):
+        'Stream rows of the given columns, restricted to rows modified since fromModifiedDate if the table has a timestamp column'
+        from sqlalchemy import select
+        statement = select([table.c[x] for x in columnNames], whereclause)
+        if fromModifiedDate is not None and self.timestampColumnName and self.timestampColumnName in table.c:
+            statement = statement.where(table.c[self.timestampColumnName] >= fromModifiedDate)
+        # Backends with server-side cursors stream rows; mssql+pyodbc ignores this and the driver buffers them,
+        # so fetchmany only bounds the number of rows turned into Python objects at a time
+        connection = self.engine.connect().execution_options(stream_results=True)
+        try:
+            result = connection.execute(statement)
+            while True:
+                rows = result.fetchmany(self.fetchSize)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            connection.close()
+
+    def get_technologies(self, fromModifiedDate=None):
+        table = self.tables['TECHNOL']
         technologies = []
-        for technology in self.db.query(Technology):
+        for technology in self.select(table, ['PRIMARYKEY', 'TECHID', 'NAME'], fromModifiedDate):
             technology = {
                 'id': int(technology.PRIMARYKEY),
                 'case': strip(technology.TECHID),
@@ -25,11 +65,21 @@ class Inteum(object):
             technologies.append(technology)
         return technologies
 
-    def get_patents(self):
-        class Patent(self.Base):
-            __table__ = self.tables['PATENTS']
+    def get_patents(self, fromModifiedDate=None, skipInsufficient=True):
+        table = self.tables['PATENTS']
         patents = []
-        for patent in self.db.query(Patent):
+        for patent in self.select(table, [
+            'PRIMARYKEY',
+            'TECHNOLFK',
+            'NAME',
+            'LAWFIRMFK',
+            'LEGALREFNO',
+            'FILEDATE',
+            'SERIALNO',
+            'PATSTATFK',
+            'PAPPTYPEFK',
+            'COUNTRYFK',
+        ], fromModifiedDate):
             patent = {
                 'id': int(patent.PRIMARYKEY),
                 'technologyID': int(patent.TECHNOLFK),
@@ -43,16 +93,15 @@ class Inteum(object):
                 'countryID': int(patent.COUNTRYFK),
             }
             # Skip patents with insufficient information
-            if not patent['lawFirmCase'] or not patent['serial']:
+            if skipInsufficient and not has_sufficient_information(patent):
                 continue
             patents.append(patent)
         return patents
 
-    def get_patentTypes(self):
-        class PatentType(self.Base):
-            __table__ = self.tables['PAPPTYPE']
+    def get_patentTypes(self, fromModifiedDate=None):
+        table = self.tables['PAPPTYPE']
         patentTypes = []
-        for patentType in self.db.query(PatentType):
+        for patentType in self.select(table, ['PRIMARYKEY', 'NAME'], fromModifiedDate):
             patentType = {
                 'id': int(patentType.PRIMARYKEY),
                 'name': strip(patentType.NAME),
@@ -60,11 +109,10 @@ class Inteum(object):
             patentTypes.append(patentType)
         return patentTypes
 
-    def get_lawFirms(self):
-        class Company(self.Base):
-            __table__ = self.tables['COMPANY']
+    def get_lawFirms(self, fromModifiedDate=None):
+        table = self.tables['COMPANY']
         lawFirms = []
-        for lawFirm in self.db.query(Company).filter_by(TYPE='L'):
+        for lawFirm in self.select(table, ['PRIMARYKEY', 'NAME'], fromModifiedDate, table.c.TYPE == 'L'):
             lawFirm = {
                 'id': lawFirm.PRIMARYKEY,
                 'name': lawFirm.NAME,
@@ -72,11 +120,10 @@ class Inteum(object):
             lawFirms.append(lawFirm)
         return lawFirms
 
-    def get_countries(self):
-        class Country(self.Base):
-            __table__ = self.tables['COUNTRY']
+    def get_countries(self, fromModifiedDate=None):
+        table = self.tables['COUNTRY']
         countries = []
-        for country in self.db.query(Country):
+        for country in self.select(table, ['PRIMARYKEY', 'NAME'], fromModifiedDate):
             country = {
                 'id': country.PRIMARYKEY,
                 'name': country.NAME,
@@ -85,5 +132,46 @@ class Inteum(object):
         return countries
 
 
+def reflect_tables(engine, tableNames, cachePath=None):
+    'Return the given tables by name, reusing metadata cached for the same server, database and columns'
+    cacheKey = str(engine.url), tuple(sorted(tableNames))
+    metadataByKey = {}
+    if cachePath and os.path.exists(cachePath):
+        try:
+            metadataByKey = pickle.load(open(cachePath, 'rb'))
+        except Exception:
+            metadataByKey = {}
+    # Reflect again if a column was added, removed, renamed or retyped since the metadata was cached
+    fingerprint = get_columnFingerprint(engine, tableNames) if cachePath else None
+    try:
+        cachedFingerprint, metadata = metadataByKey[cacheKey]
+    except (KeyError, TypeError, ValueError):
+        cachedFingerprint, metadata = None, None
+    if metadata is None or cachedFingerprint != fingerprint:
+        from sqlalchemy import MetaData
+        metadata = MetaData()
+        metadata.reflect(engine, only=tableNames)
+        if cachePath:
+            metadataByKey[cacheKey] = fingerprint, metadata
+            pickle.dump(metadataByKey, open(cachePath, 'wb'), pickle.HIGHEST_PROTOCOL)
+    return metadata.tables
+
+
+def get_columnFingerprint(engine, tableNames):
+    'Return sorted (table, column, type) for the given tables in one query, which is much cheaper than reflecting them'
+    from sqlalchemy import MetaData, Table, Column, String, select
+    columns = Table('COLUMNS', MetaData(),
+        Column('TABLE_NAME', String),
+        Column('COLUMN_NAME', String),
+        Column('DATA_TYPE', String),
+        schema='INFORMATION_SCHEMA')
+    rows = engine.execute(select([columns.c.TABLE_NAME, columns.c.COLUMN_NAME, columns.c.DATA_TYPE], columns.c.TABLE_NAME.in_(tableNames))).fetchall()
+    return tuple(sorted(tuple(x) for x in rows))
+
+
+def has_sufficient_information(patent):
+    return patent['lawFirmCase'] and patent['serial']
+
+
 def strip(text):
     return text.strip() if text else ''
@@ -3,4 +3,11 @@ QUICKBOOKS_CUSTOMER_NAME_LEN_MAX = 41
 QUICKBOOKS_VENDOR_NAME_LEN_MAX = 41
 QUICKBOOKS_MEMO_LEN_MAX = 4095
 QUICKBOOKS_SEPARATOR = ' - '
+QUICKBOOKS_OFFLINE = False
+QUICKBOOKS_METRICS_PATH = 'quickbooks-metrics.json'
+QUICKBOOKS_TRACE_FOLDER = ''
 INTEUM_DSN = 'inteumCSdb'
+INTEUM_TIMESTAMP_COLUMN = 'DATEMODIFIED'
+INTEUM_METADATA_CACHE_PATH = 'inteum-metadata.pickle'
+SYNC_STATE_PATH = 'inteum-quickbooks-sync.sqlite'
+SYNC_FULL_SCAN_DAYS = 7
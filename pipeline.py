@@ -0,0 +1,427 @@
+'Synchronization pipeline shared by the window in go.py and the command line in sync.py'
+import time
+import datetime
+import traceback
+from Queue import Queue, Empty
+from collections import OrderedDict, defaultdict
+from threading import Thread
+
+from changeSet import make_change, get_diff, save_changes, load_changes
+from csvI import load_folder, drop_repeated_invoices
+from parameters import *
+from quickbooks import QuickBooks
+from quickbooks.qbtrace import QBTrace
+from quickbooksR import QBRosetta
+from inteumI import Inteum, has_sufficient_information
+from syncState import SyncState
+
+
+class TaskThread(Thread):
+    'Run a function in a separate thread and keep its result, error and duration'
+
+    def __init__(self, function, signal_end=None):
+        super(TaskThread, self).__init__()
+        self.function = function
+        self.signal_end = signal_end
+        self.result = None
+        self.error = None
+        self.timeStart = None
+        self.timeEnd = None
+        self.seconds = 0
+
+    def run(self):
+        self.timeStart = time.time()
+        try:
+            self.result = self.function()
+        except Exception:
+            self.error = traceback.format_exc()
+        self.timeEnd = time.time()
+        self.seconds = self.timeEnd - self.timeStart
+        if self.signal_end:
+            self.signal_end(self)
+
+
+class StageScheduler(object):
+    'Run tasks once their dependencies finish, worker tasks in threads and main tasks on the calling thread'
+
+    def __init__(self):
+        # Map task name to (function, dependencies, onMainThread)
+        self.taskPackByName = OrderedDict()
+        self.pendingNames = []
+        self.resultByName = {}
+        self.timePackByName = {}
+
+    def add(self, name, function, dependencies=(), onMainThread=False):
+        'Add a task before or, from a main task, during run; ready main tasks run in the order they were added'
+        self.taskPackByName[name] = function, list(dependencies), onMainThread
+        self.pendingNames.append(name)
+
+    def run(self, save_task=lambda name, timeStart, timeEnd: None, start_task=lambda name: None):
+        'Run every task, call start_task and save_task as each one starts and finishes and return results by name'
+        endedThreads = Queue()
+        pendingNames = self.pendingNames
+        runningThreadCount = 0
+        while pendingNames or runningThreadCount:
+            # Collect finished worker tasks, waiting only if nothing else can run
+            while runningThreadCount:
+                readyNames = [x for x in pendingNames if self.is_ready(x)]
+                try:
+                    thread = endedThreads.get(block=not readyNames)
+                except Empty:
+                    break
+                runningThreadCount -= 1
+                if thread.error:
+                    raise PipelineError('Could not run %s:\n%s' % (thread.name, thread.error))
+                self.end_task(thread.name, thread.result, thread.timeStart, thread.timeEnd, save_task)
+            readyNames = [x for x in pendingNames if self.is_ready(x)]
+            if not readyNames and not runningThreadCount:
+                raise PipelineError('Could not satisfy dependencies of %s' % ', '.join(pendingNames))
+            for name in readyNames:
+                function, dependencies, onMainThread = self.taskPackByName[name]
+                if onMainThread:
+                    continue
+                pendingNames.remove(name)
+                start_task(name)
+                thread = TaskThread(function, endedThreads.put)
+                thread.name = name
+                thread.daemon = True
+                thread.start()
+                runningThreadCount += 1
+            # Run one main task at a time so that finished worker tasks can unblock earlier main tasks
+            for name in readyNames:
+                function, dependencies, onMainThread = self.taskPackByName[name]
+                if onMainThread:
+                    pendingNames.remove(name)
+                    start_task(name)
+                    timeStart = time.time()
+                    result = function()
+                    self.end_task(name, result, timeStart, time.time(), save_task)
+                    break
+        return self.resultByName
+
+    def is_ready(self, name):
+        return all(x in self.resultByName for x in self.taskPackByName[name][1])
+
+    def end_task(self, name, result, timeStart, timeEnd, save_task):
+        self.resultByName[name] = result
+        self.timePackByName[name] = timeStart, timeEnd
+        save_task(name, timeStart, timeEnd)
+
+
+class Pipeline(object):
+    'Load Inteum, QuickBooks and spreadsheet records, match each stage in parallel and write the stages in dependency order'
+
+    def __init__(self, callbackByKey):
+        # Expects show_text, show_progress, prompt_update, prompt_save, show_error, show_save_error and summarize_* callbacks
+        self.callbackByKey = callbackByKey
+        self.show_text = callbackByKey.get('show_text', lambda text: None)
+        # Called from any thread with a task name and its status and counts so far
+        self.show_progress = callbackByKey.get('show_progress', lambda stageName, valueByKey: None)
+        self.stageResults = []
+        self.timeStart = time.time()
+        # QuickBooks request metrics of the last run
+        self.metrics = None
+
+    def run(self, pathPacks, qb=None, changeSetPath=None, fullScan=False):
+        'Synchronize expenses from (module, path) pairs and return a dictionary for each task; given changeSetPath, save the changes there instead of writing them'
+        # Given fullScan, query every record instead of those changed since the last run to catch records that were deleted or merged
+        self.stageResults = []
+        self.timeStart = time.time()
+        self.show_text('Connecting to Inteum... ')
+        inteum = Inteum(INTEUM_DSN, INTEUM_TIMESTAMP_COLUMN, metadataCachePath=INTEUM_METADATA_CACHE_PATH)
+        syncState = SyncState(SYNC_STATE_PATH, datetime.timedelta(days=SYNC_FULL_SCAN_DAYS))
+        self.show_text('OK\n')
+        if not qb:
+            qb = make_quickbooks()
+        scheduler = StageScheduler()
+        get_result = lambda name: scheduler.resultByName[name]
+        # Worker tasks store counts here for the stage results
+        valueByKeyByName = {}
+
+        def load_inteum(name, tableName, get_values):
+            # Fetch only rows changed since the last run and merge them with the stored snapshot
+            def load():
+                values = syncState.refresh('Inteum' + tableName, lambda fromModifiedDate: (
+                    inteum.get_timestamp(), get_values(fromModifiedDate)), lambda value: value['id'], fullScan)
+                valueByKeyByName['load Inteum ' + name] = dict(count=len(values))
+                return values
+            return load
+
+        # Load Inteum tables in parallel, each thread on its own pooled connection
+        inteumPacks = [
+            ('technologies', 'TECHNOL', inteum.get_technologies),
+            # Keep patents with insufficient information so that a refresh replaces the stored copy of a patent
+            # that loses its serial; prepare_stages filters them after merging
+            ('patents', 'PATENTS', lambda fromModifiedDate: inteum.get_patents(fromModifiedDate, skipInsufficient=False)),
+            ('patentTypes', 'PAPPTYPE', inteum.get_patentTypes),
+            ('lawFirms', 'COMPANY', inteum.get_lawFirms),
+            ('countries', 'COUNTRY', inteum.get_countries),
+        ]
+        for name, tableName, get_values in inteumPacks:
+            scheduler.add('load Inteum ' + name, load_inteum(name, tableName, get_values))
+
+        # Meanwhile, query QuickBooks from this thread because COM calls must stay on the thread that connected
+        def connect_quickbooks():
+            qb.metrics.taskName = 'connect QuickBooks'
+            if not qb.offline:
+                self.show_text('Connecting to QuickBooks... ')
+                qb.connect()
+                self.show_text('OK\n')
+        scheduler.add('connect QuickBooks', connect_quickbooks, onMainThread=True)
+
+        def load_quickbooks(name, objectType, requestDictionary, fullScan=False):
+            def load():
+                qb.metrics.taskName = name
+                rawResults = list(qb.load(objectType, requestDictionary, syncState, fullScan))
+                valueByKeyByName[name] = dict(count=len(rawResults))
+                return rawResults
+            return load
+
+        for objectType, requestDictionary in [
+            ('Vendor', None),
+            ('Customer', None),
+            ('Account', None),
+            ('Bill', {'IncludeLineItems': 1}),
+        ]:
+            scheduler.add('load QuickBooks ' + objectType, load_quickbooks('load QuickBooks ' + objectType, objectType, requestDictionary, fullScan), ['connect QuickBooks'], onMainThread=True)
+
+        def prepare_stages():
+            technologies, patents, patentTypes, lawFirms, countries = [get_result('load Inteum ' + x[0]) for x in inteumPacks]
+            patents = filter(has_sufficient_information, patents)
+            # Expenses are read from the spreadsheets as the expense stage consumes them
+            inteumTables = technologies, patents, patentTypes, lawFirms, countries
+            if len(pathPacks) == 1:
+                module, path = pathPacks[0]
+                qbr = module(*inteumTables)
+                lawFirmExpenses = drop_repeated_invoices(qbr.load_expenses(path))
+            else:
+                qbr = QBRosetta(*inteumTables)
+                lawFirmExpenses = load_folder(pathPacks, inteumTables)
+            return get_stagePacks(qbr, technologies, patents, lawFirms, lawFirmExpenses)
+        scheduler.add('prepare stages', prepare_stages, ['load Inteum ' + x[0] for x in inteumPacks])
+
+        def schedule_stages():
+            # Match each stage in its own thread as soon as its QuickBooks objects are loaded,
+            # but write through the session in order after the stages whose objects it refers to
+            stagePacks = get_result('prepare stages')
+            objectTypeByStageName = dict((x[0], x[2]) for x in stagePacks)
+            stageNames = []
+            for stageName, candidatePacks, objectType, stageCallbackByKey, requestDictionary, dependencies in stagePacks:
+                stageNames.append(stageName)
+                loadName = 'load QuickBooks ' + objectType
+                # A stage whose dependencies write its own object type matches against objects loaded again after them,
+                # so that jobs see the customers that were just renamed or added and carry a current EditSequence
+                reloadDependencies = [x for x in dependencies if objectTypeByStageName[x] == objectType]
+                if reloadDependencies and not changeSetPath:
+                    loadName = 'reload QuickBooks %s for %s' % (objectType, stageName)
+                    scheduler.add(loadName, load_quickbooks(loadName, objectType, requestDictionary), ['apply ' + x for x in reloadDependencies], onMainThread=True)
+                scheduler.add('plan ' + stageName, self.plan(
+                    qb, stageName, candidatePacks, objectType, stageCallbackByKey, requestDictionary,
+                    syncState, lambda loadName=loadName: get_result(loadName),
+                    valueByKeyByName, approveAll=changeSetPath is not None), [loadName])
+                if changeSetPath:
+                    continue
+                scheduler.add('apply ' + stageName, self.apply(
+                    qb, stageName, lambda stageName=stageName: get_result('plan ' + stageName),
+                    syncState, valueByKeyByName), ['plan ' + stageName] + ['apply ' + x for x in dependencies], onMainThread=True)
+            if changeSetPath:
+                scheduler.add('save changes', lambda: self.save_changes(
+                    qb, changeSetPath, [(x, get_result('plan ' + x)) for x in stageNames],
+                    valueByKeyByName), ['plan ' + x for x in stageNames], onMainThread=True)
+        scheduler.add('schedule stages', schedule_stages, ['prepare stages'], onMainThread=True)
+
+        self.metrics = qb.metrics
+        try:
+            scheduler.run(
+                lambda name, timeStart, timeEnd: self.save_stageResult(name, timeStart, timeEnd, **valueByKeyByName.get(name, {})),
+                lambda name: self.show_progress(name, {'status': 'running'}))
+        finally:
+            self.save_metrics()
+            if qb.trace:
+                qb.trace.flush()
+        return self.stageResults
+
+    def plan(self, qb, stageName, candidatePacks, objectType, stageCallbackByKey, requestDictionary, syncState, get_rawResults, valueByKeyByName, approveAll=False):
+        'Return a task that matches one sync stage and records its counts'
+        def plan():
+            errors = []
+            callbackByKey = dict(stageCallbackByKey)
+            for key in 'summarize_candidatePacks', 'summarize_mismatches', 'summarize_newPacks':
+                if key in self.callbackByKey:
+                    callbackByKey[key] = self.callbackByKey[key]
+            callbackByKey['show_parse_error'] = self.record_error(errors, self.callbackByKey.get('show_parse_error'))
+            callbackByKey['show_format_error'] = self.record_error(errors, self.callbackByKey.get('show_format_error'))
+            callbackByKey['show_save_error'] = self.record_error(errors, self.callbackByKey.get('show_save_error'), 'Could not save %s: %s')
+            callbackByKey['add_progress'] = self.count_progress('plan ' + stageName)
+            # Stages without prompts keep the defaults of their callbackByKey
+            for key in 'prompt_update', 'prompt_save':
+                if key not in stageCallbackByKey:
+                    continue
+                if approveAll:
+                    callbackByKey[key] = lambda *args: True
+                elif key in self.callbackByKey:
+                    callbackByKey[key] = self.callbackByKey[key]
+            syncPlan = qb.plan(candidatePacks, objectType, callbackByKey, requestDictionary, syncState, rawResults=get_rawResults())
+            syncPlan.errors = errors
+            valueByKeyByName['plan ' + stageName] = dict(
+                candidateCount=len(syncPlan.candidatePacks),
+                mismatchCount=len(syncPlan.mismatches),
+                newCount=len(syncPlan.newPacks),
+                errorCount=len(errors))
+            return syncPlan
+        return plan
+
+    def apply(self, qb, stageName, get_syncPlan, syncState, valueByKeyByName):
+        'Return a task that writes one sync stage and records its errors'
+        def apply():
+            syncPlan = get_syncPlan()
+            self.show_text('Updating %s in QuickBooks...\n' % stageName)
+            errorCount = len(syncPlan.errors)
+            syncPlan.callbackByKey['add_progress'] = self.count_progress('apply ' + stageName)
+            qb.metrics.taskName = 'apply ' + stageName
+            qb.apply(syncPlan, syncState=syncState)
+            valueByKeyByName['apply ' + stageName] = dict(errorCount=len(syncPlan.errors) - errorCount)
+        return apply
+
+    def save_changes(self, qb, changeSetPath, syncPlanPacks, valueByKeyByName):
+        'Save the requests of every stage with field differences for updates and the errors found while planning'
+        changes = []
+        for stageName, syncPlan in syncPlanPacks:
+            objectType = syncPlan.objectType
+            diffByPackID = dict((id(pack), get_diff(pack, oldPack, objectType)) for pack, oldPack in syncPlan.mismatches)
+            for savePacks in qb.iter_savePacks(syncPlan):
+                for pack, (requestType, requestDictionary) in savePacks:
+                    diff = diffByPackID.get(id(pack))
+                    if diff is None and requestType.endswith('ModRq') and 'lawFirmExpenses' in pack:
+                        # Mismatched expenses are collapsed into one pack per bill, so report their differences by line
+                        diff = OrderedDict((x['TxnLineID'], diffByPackID[id(x)]) for x in pack['lawFirmExpenses'] if id(x) in diffByPackID)
+                    changes.append(make_change(stageName, objectType, requestType, diff, requestDictionary))
+            for error in syncPlan.errors:
+                changes.append(make_change(stageName, objectType, error=error))
+        save_changes(changeSetPath, changes)
+        valueByKeyByName['save changes'] = dict(
+            changeCount=sum(1 for x in changes if not x['error']),
+            errorCount=sum(1 for x in changes if x['error']))
+        self.show_text('Saved changes to %s\n' % changeSetPath)
+
+    def apply_changes(self, changeSetPath, qb=None, batchSize=100):
+        'Write the changes saved by a dry run in one batched pass, stage by stage in the saved order'
+        self.stageResults = []
+        self.timeStart = time.time()
+        syncState = SyncState(SYNC_STATE_PATH, datetime.timedelta(days=SYNC_FULL_SCAN_DAYS))
+        if not qb:
+            qb = make_quickbooks()
+        self.metrics = qb.metrics
+        self.show_text('Connecting to QuickBooks... ')
+        qb.connect()
+        self.show_text('OK\n')
+        # Group requests by stage, skipping errors that were only recorded for review
+        savePacksByStageName = OrderedDict()
+        objectTypeByStageName = {}
+        for change in load_changes(changeSetPath):
+            if change['error']:
+                continue
+            stageName = change['stage']
+            objectTypeByStageName[stageName] = change['objectType']
+            savePacksByStageName.setdefault(stageName, []).append((change['request'], (change['requestType'], change['request'])))
+        for stageName, savePacks in savePacksByStageName.items():
+            errors = []
+            self.show_progress('apply ' + stageName, {'status': 'running'})
+            qb.metrics.taskName = 'apply ' + stageName
+            timeStart = time.time()
+            qb.save_batch(objectTypeByStageName[stageName], savePacks, self.record_error(
+                errors, self.callbackByKey.get('show_save_error'), 'Could not save %s: %s'), batchSize, syncState,
+                add_progress=self.count_progress('apply ' + stageName))
+            self.save_stageResult('apply ' + stageName, timeStart, time.time(), count=len(savePacks), errorCount=len(errors))
+        self.save_metrics()
+        if qb.trace:
+            qb.trace.flush()
+        return self.stageResults
+
+    def save_metrics(self):
+        'Write QuickBooks request metrics for the run if QUICKBOOKS_METRICS_PATH is set'
+        if QUICKBOOKS_METRICS_PATH and self.metrics:
+            self.metrics.save(QUICKBOOKS_METRICS_PATH)
+
+    def count_progress(self, stageName):
+        'Return a callback that adds to the counts of a task and shows their totals'
+        countByKey = defaultdict(int)
+        def add_progress(**valueByKey):
+            for key, value in valueByKey.iteritems():
+                countByKey[key] += value
+            self.show_progress(stageName, dict(countByKey))
+        return add_progress
+
+    def record_error(self, errors, show_error, errorTemplate='%s'):
+        def record_error(*args):
+            errors.append(errorTemplate % args)
+            if show_error:
+                show_error(*args)
+        return record_error
+
+    def save_stageResult(self, stageName, timeStart, timeEnd, **valueByKey):
+        # Report times relative to the start of the run so that the critical path can be read off
+        stageResult = OrderedDict([
+            ('stage', stageName),
+            ('start', round(timeStart - self.timeStart, 3)),
+            ('end', round(timeEnd - self.timeStart, 3)),
+            ('seconds', round(timeEnd - timeStart, 3)),
+        ])
+        stageResult.update(sorted(valueByKey.items()))
+        self.stageResults.append(stageResult)
+        self.show_progress(stageName, dict(stageResult.items()[1:], status='done'))
+        self.show_text('%s: %s\n' % (stageName, ', '.join('%s=%s' % x for x in stageResult.items()[1:])))
+
+
+def make_quickbooks(offline=QUICKBOOKS_OFFLINE, traceFolder=QUICKBOOKS_TRACE_FOLDER):
+    'Return a QuickBooks session for this application that traces its requests to traceFolder if given'
+    trace = QBTrace(traceFolder) if traceFolder else None
+    return QuickBooks(applicationName=QUICKBOOKS_APPLICATION_NAME, offline=offline, trace=trace)
+
+
+def get_stagePacks(qbr, technologies, patents, lawFirms, lawFirmExpenses):
+    'Return (stageName, candidatePacks, objectType, callbackByKey, requestDictionary, dependencies) for each sync stage in order'
+    # Stages without prompt_update never update existing objects
+    # A stage writes only after its dependencies, whose objects it refers to
+    promptByKey = dict(
+        prompt_update=lambda pack, oldPack: True,
+        prompt_save=lambda newPacks, newResults: True)
+    return [
+        ('vendors', lawFirms, 'Vendor', dict(promptByKey,
+            equal=qbr.equal_lawFirm,
+            key=qbr.key_lawFirm,
+            parse_result=qbr.parse_vendor,
+            update_result=qbr.format_vendor,
+            format_result=qbr.format_vendor), None, []),
+        ('customers', technologies, 'Customer', dict(promptByKey,
+            equal=qbr.equal_technology,
+            key=qbr.key_technology,
+            parse_result=qbr.parse_customer,
+            update_result=qbr.format_customer,
+            format_result=qbr.format_customer), None, []),
+        ('jobs', patents, 'Customer', dict(promptByKey,
+            equal=qbr.equal_patent,
+            key=qbr.key_patent,
+            parse_result=qbr.parse_job,
+            update_result=qbr.format_job,
+            format_result=qbr.format_job), None, ['customers']),
+        ('accounts', [{'name': '6100 - Patent Related Expenses'}], 'Account', dict(
+            equal=lambda account1, account2: account1['name'].lower() == account2['name'].lower(),
+            key=lambda account: account['name'].lower(),
+            parse_result=lambda result: {'name': result['FullName']},
+            format_result=lambda account, show_format_error: OrderedDict([('Name', account['name']), ('AccountType', 'Expense')]),
+            prompt_save=promptByKey['prompt_save']), None, []),
+        ('expenses', lawFirmExpenses, 'Bill', dict(promptByKey,
+            equal=qbr.equal_expense,
+            key=qbr.key_expense,
+            parse_result=qbr.parse_bill,
+            update_result=qbr.update_bill,
+            format_result=qbr.format_bill,
+            expand_results=qbr.expand_bills,
+            collapse_mismatches=qbr.collapse_mismatches,
+            collapse_packs=qbr.collapse_expenses), {'IncludeLineItems': 1}, ['vendors', 'jobs', 'accounts']),
+    ]
+
+
+class PipelineError(Exception):
+    pass
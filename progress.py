@@ -0,0 +1,46 @@
+'Pass text and stage progress from the synchronization thread to the window in batches'
+from Queue import Queue, Empty
+from collections import OrderedDict
+
+
+# Number of events to take per drain so that a flood of text cannot freeze the window
+DRAIN_COUNT_MAX = 10000
+
+
+class ProgressQueue(object):
+    'Collect events from any thread for the window thread to drain on a timer'
+
+    def __init__(self):
+        self.queue = Queue()
+
+    def show_text(self, text):
+        self.queue.put((None, text))
+
+    def show_progress(self, stageName, valueByKey):
+        self.queue.put((stageName, dict(valueByKey)))
+
+    def empty(self):
+        return self.queue.empty()
+
+    def clear(self):
+        'Discard events left over from an earlier task'
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                return
+
+    def drain(self, countMax=DRAIN_COUNT_MAX):
+        'Return the text posted since the last drain and the latest values of each stage that changed'
+        texts = []
+        valueByKeyByStageName = OrderedDict()
+        for eventIndex in xrange(countMax):
+            try:
+                stageName, value = self.queue.get_nowait()
+            except Empty:
+                break
+            if stageName is None:
+                texts.append(value)
+            else:
+                valueByKeyByStageName.setdefault(stageName, {}).update(value)
+        return ''.join(texts), valueByKeyByStageName
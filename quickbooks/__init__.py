@@ -1,4 +1,4 @@
-from quickbooks.qbcom import QuickBooks, ParseSkip, ParseError, MismatchError
+from quickbooks.qbcom import QuickBooks, ParseSkip, ParseError, MismatchError, QBConnectionError
 
 
 __all__ = [
@@ -6,4 +6,5 @@ __all__ = [
     'ParseSkip',
     'ParseError', 
     'MismatchError',
+    'QBConnectionError',
 ]
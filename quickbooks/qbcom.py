@@ -1,39 +1,61 @@
 'Convenience classes for interacting with QuickBooks via win32com'
+import time
 import datetime
-from win32com.client import Dispatch, constants
-from win32com.client.makepy import GenerateFromTypeLibSpec
-from pythoncom import CoInitialize
-from pywintypes import com_error
-from collections import OrderedDict
+from itertools import chain
+from collections import OrderedDict, defaultdict
 
-from quickbooks.qbxml import format_request, parse_response
+from quickbooks.qbxml import format_request, format_batch_request, parse_response, parse_batch_response, iter_response
+from quickbooks.qbschema import decode_response_part
+from quickbooks.qbmetrics import QBMetrics
 
 
-# After running the following command, you can check the generated type library
-# for a list of dispatchable classes and their associated methods.
-# The generated type library should be in site-packages/win32com/gen_py/
-# e.g. /Python27/Lib/site-packages/win32com/gen_py/
-GenerateFromTypeLibSpec('QBXMLRP2 1.0 Type Library')
+# Values of QBXMLRPConnectionType and QBFileMode in the QBXMLRP2 type library
+CONNECTION_TYPE_LOCAL_QBD = 1
+FILE_MODE_DO_NOT_CARE = 2
+# Queries on transactions filter by ModifiedDateRangeFilter instead of FromModifiedDate
+TRANSACTION_TYPES = ['Bill', 'Check', 'CreditCardCharge', 'Deposit', 'Invoice', 'JournalEntry', 'ReceivePayment']
+# QuickBooks rejects a Mod whose EditSequence is out of date with this status
+STATUS_CODE_STALE_EDIT_SEQUENCE = '3200'
+# Number of candidates to match between calls to add_progress
+PROGRESS_INTERVAL = 1000
 
 
 class QuickBooks(object):
     'Wrapper for the QuickBooks RequestProcessor COM interface'
 
-    def __init__(self, applicationID='', applicationName='Example', connectionType=constants.localQBD, companyFileName=''):
+    def __init__(self, applicationID='', applicationName='Example', connectionType=CONNECTION_TYPE_LOCAL_QBD, companyFileName='', offline=False, requestProcessor=None, metrics=None, trace=None):
+        'Prepare to connect when the first request is sent'
+        self.applicationID = applicationID
+        self.applicationName = applicationName
+        self.connectionType = connectionType
+        self.companyFileName = companyFileName
+        # When offline, synchronize matches against the syncState cache and only connects to write
+        self.offline = offline
+        # Use an object with the RequestProcessor interface, such as quickbooks.qbsim.RequestProcessor, instead of COM
+        self.requestProcessor = requestProcessor
+        self.session = None
+        # Count requests and time their formatting, round trips and parsing
+        self.metrics = metrics or QBMetrics()
+        # Hand each request and response to an object with the quickbooks.qbtrace.QBTrace interface
+        self.trace = trace
+
+    def connect(self):
         'Connect'
-        CoInitialize() # Needed in case we are running in a separate thread
-        try:
-            self.requestProcessor = Dispatch('QBXMLRP2.RequestProcessor.1')
-        except com_error, error:
-            raise QuickBooksError('Could not access QuickBooks COM interface: %s' % error)
+        if self.session is not None:
+            return
+        requestProcessor = self.requestProcessor or dispatch_requestProcessor()
         try:
-            self.requestProcessor.OpenConnection2(applicationID, applicationName, connectionType)
-            self.session = self.requestProcessor.BeginSession(companyFileName, constants.qbFileOpenDoNotCare)
-        except com_error, error:
+            requestProcessor.OpenConnection2(self.applicationID, self.applicationName, self.connectionType)
+            session = requestProcessor.BeginSession(self.companyFileName, FILE_MODE_DO_NOT_CARE)
+        except get_connectionErrors(requestProcessor), error:
             raise QuickBooksError('Could not start QuickBooks COM interface: %s' % error)
+        self.requestProcessor = requestProcessor
+        self.session = session
 
     def __del__(self):
         'Disconnect'
+        if self.session is None:
+            return
         try:
             self.requestProcessor.EndSession(self.session)
             self.requestProcessor.CloseConnection()
@@ -42,24 +64,123 @@ class QuickBooks(object):
 
     def call(self, requestType, requestDictionary=None, qbxmlVersion='8.0', onError='stopOnError', saveXML=False):
         'Send request and parse response'
+        response = self.process(requestType, requestDictionary, qbxmlVersion, onError, saveXML=saveXML)
+        timeStart = time.time()
+        try:
+            return parse_response(response)
+        finally:
+            self.metrics.record_parse(requestType, time.time() - timeStart)
+
+    def process(self, requestType, requestDictionary=None, qbxmlVersion='8.0', onError='stopOnError', requestAttributes=None, saveXML=False):
+        'Send request and return raw response'
+        timeStart = time.time()
+        request = format_request(requestType, requestDictionary or {}, qbxmlVersion, onError, requestAttributes)
+        return self.send(request, saveXML, requestType, time.time() - timeStart)
+
+    def send(self, request, saveXML=False, requestType='', formatSeconds=0, requestCount=1):
+        'Send formatted request, record its size and round trip in metrics and return raw response'
         def save_timestamp(name, content):
             now = datetime.datetime.now()
             open(now.strftime('%Y%m%d-%H%M%S') + '-%06i-%s' % (now.microsecond, name), 'wt').write(content)
-        request = format_request(requestType, requestDictionary or {}, qbxmlVersion, onError)
+        self.connect()
         if saveXML:
             save_timestamp('request.xml', request)
+        timeStart = time.time()
         response = self.requestProcessor.ProcessRequest(self.session, request)
+        sendSeconds = time.time() - timeStart
+        self.metrics.record_call(requestType, requestCount, formatSeconds, sendSeconds, len(request), len(response))
+        if self.trace:
+            self.trace.write(self.metrics.taskName, requestType, requestCount, sendSeconds, request, response)
         if saveXML:
             save_timestamp('response.xml', response)
-        return parse_response(response)
+        return response
+
+    def call_batch(self, requestPacks, batchSize=100, qbxmlVersion='8.0', onError='continueOnError', saveXML=False, add_progress=None):
+        'Send (requestType, requestDictionary) pairs batchSize at a time and return (status, results) for each in order'
+        responsePacks = []
+        for batchIndex in xrange(0, len(requestPacks), batchSize):
+            batchPacks = requestPacks[batchIndex:batchIndex + batchSize]
+            # Name a batch that mixes request types by all of them
+            requestType = '+'.join(sorted(set(x[0] for x in batchPacks)))
+            timeStart = time.time()
+            request = format_batch_request(batchPacks, qbxmlVersion, onError)
+            response = self.send(request, saveXML, requestType, time.time() - timeStart, len(batchPacks))
+            timeStart = time.time()
+            packByRequestID = parse_batch_response(response, decode_response_part)
+            self.metrics.record_parse(requestType, time.time() - timeStart)
+            for requestIndex in xrange(len(batchPacks)):
+                # Requests after a failure are dropped when onError=stopOnError
+                responsePacks.append(packByRequestID.get(str(requestIndex + 1), ({
+                    'statusSeverity': 'Error',
+                    'statusMessage': 'Request was not processed',
+                }, [])))
+            if add_progress:
+                add_progress(writtenCount=len(batchPacks))
+        return responsePacks
+
+    def iter_query(self, objectType, requestDictionary=None, pageSize=500, fromModifiedDate=None, qbxmlVersion='8.0', saveXML=False):
+        'Yield query results as typed records one page at a time using a QBXML iterator'
+        requestType = objectType + 'QueryRq'
+        # MaxReturned and the modified date filter must precede the other query filters
+        requestParts = [('MaxReturned', pageSize)]
+        if fromModifiedDate is None:
+            pass
+        elif objectType in TRANSACTION_TYPES:
+            requestParts.append(('ModifiedDateRangeFilter', {'FromModifiedDate': fromModifiedDate}))
+        else:
+            requestParts.append(('FromModifiedDate', fromModifiedDate))
+        requestDictionary = OrderedDict(requestParts + (requestDictionary or {}).items())
+        requestAttributes = {'iterator': 'Start'}
+        while True:
+            response = self.process(requestType, requestDictionary, qbxmlVersion, requestAttributes=requestAttributes, saveXML=saveXML)
+            statusByKey = {}
+            results = iter_response(response, statusByKey, decode_response_part)
+            # Time parsing without the time that the consumer spends between records
+            parseSeconds = 0
+            while True:
+                timeStart = time.time()
+                try:
+                    result = next(results)
+                except StopIteration:
+                    break
+                finally:
+                    parseSeconds += time.time() - timeStart
+                yield result
+            self.metrics.record_parse(requestType, parseSeconds)
+            if statusByKey.get('statusSeverity') == 'Error':
+                raise QuickBooksError('Could not query %s: %s' % (objectType, statusByKey.get('statusMessage')))
+            if int(statusByKey.get('iteratorRemainingCount', 0)) <= 0:
+                break
+            requestAttributes = {'iterator': 'Continue', 'iteratorID': statusByKey['iteratorID']}
+
+    def query_changed(self, objectType, requestDictionary=None, fromModifiedDate=None):
+        'Return (latest TimeModified, results) for objects modified since fromModifiedDate'
+        results = list(self.iter_query(objectType, requestDictionary, fromModifiedDate=fromModifiedDate))
+        return max([x.get('TimeModified') for x in results] or [None]), results
+
+    def load(self, objectType, requestDictionary=None, syncState=None, fullScan=False):
+        'Return query results page by page or, given syncState, from its cache updated with changes since the last run'
+        if not syncState:
+            return self.iter_query(objectType, requestDictionary)
+        name = 'QuickBooks' + objectType
+        if self.offline and not fullScan and syncState.has_snapshot(name):
+            return syncState.load_snapshot(name).values()
+        return syncState.refresh(name, lambda fromModifiedDate: self.query_changed(
+            objectType, requestDictionary, fromModifiedDate), get_objectID, fullScan)
 
-    def synchronize(self, candidatePacks, objectType, callbackByKey, requestDictionary=None, ignoreDuplicates=True):
-        'Synchronize candidatePacks on the QuickBooks objectType using the equal comparator'
-        callbackByKey.get('summarize_candidatePacks', lambda packs: None)(candidatePacks)
-        # Load oldResults
+    def synchronize(self, candidatePacks, objectType, callbackByKey, requestDictionary=None, ignoreDuplicates=True, batchSize=100, syncState=None, fullScan=False, rawResults=None):
+        'Synchronize candidatePacks on the QuickBooks objectType using the key index and equal comparator and return the number of candidates added'
+        syncPlan = self.plan(candidatePacks, objectType, callbackByKey, requestDictionary, syncState, fullScan, rawResults)
+        return self.apply(syncPlan, batchSize, syncState)
+
+    def plan(self, candidatePacks, objectType, callbackByKey, requestDictionary=None, syncState=None, fullScan=False, rawResults=None):
+        'Match candidatePacks against QuickBooks objects without writing; safe to call from any thread given rawResults'
+        # Load oldResults unless they were loaded ahead of time
+        if rawResults is None:
+            rawResults = self.load(objectType, requestDictionary, syncState, fullScan)
         parse_result = callbackByKey.get('parse_result', lambda result: result)
         oldResults = []
-        for rawResult in self.call(objectType + 'QueryRq', requestDictionary or {}):
+        for rawResult in rawResults:
             try:
                 oldResult = parse_result(rawResult)
                 oldResult[objectType] = rawResult
@@ -69,13 +190,26 @@ class QuickBooks(object):
             except ParseError, error:
                 callbackByKey.get('show_parse_error', lambda error: None)(error)
         oldPacks = callbackByKey.get('expand_results', lambda results: results)(oldResults)
+        # Index oldPacks so that equal only compares packs that share a key
+        key = callbackByKey.get('key')
+        if key:
+            oldPacksByKey = defaultdict(list)
+            for oldPack in oldPacks:
+                oldPacksByKey[key(oldPack)].append(oldPack)
+            # Compare every candidate with old packs that have no key, such as objects that someone made by hand
+            unkeyedPacks = oldPacksByKey.pop(None, [])
         # Load newResults
-        update_result = callbackByKey.get('update_result', lambda pack, show_format_error: {})
         equal = callbackByKey.get('equal', lambda pack, oldPack: True)
         newPacks = []
         mismatches = []
+        # candidatePacks may be a generator that is still reading its source, so summarize them after matching
+        checkedPacks = []
+        add_progress = callbackByKey.get('add_progress', lambda **countByKey: None)
         for pack in candidatePacks:
-            for oldPack in oldPacks:
+            checkedPacks.append(pack)
+            if len(checkedPacks) % PROGRESS_INTERVAL == 0:
+                add_progress(matchedCount=PROGRESS_INTERVAL)
+            for oldPack in chain(oldPacksByKey.get(key(pack), []), unkeyedPacks) if key else oldPacks:
                 try:
                     if equal(pack, oldPack):
                         break
@@ -84,34 +218,170 @@ class QuickBooks(object):
                     break
             else:
                 newPacks.append(pack)
+        add_progress(matchedCount=len(checkedPacks) % PROGRESS_INTERVAL)
+        return SyncPlan(objectType, callbackByKey, checkedPacks, mismatches, newPacks, requestDictionary)
+
+    def apply(self, syncPlan, batchSize=100, syncState=None):
+        'Write the updates and additions of a SyncPlan through this session and return the number of candidates added'
+        show_save_error = syncPlan.callbackByKey.get('show_save_error', lambda pack, error: None)
+        add_progress = syncPlan.callbackByKey.get('add_progress')
+        replan_stale = lambda objectIDs: self.replan(syncPlan, objectIDs, batchSize)
+        for savePacks in self.iter_savePacks(syncPlan):
+            self.save_batch(syncPlan.objectType, savePacks, show_save_error, batchSize, syncState, add_progress, replan_stale)
+        return syncPlan.addCount
+
+    def iter_savePacks(self, syncPlan):
+        'Yield the (pack, (requestType, requestDictionary)) pairs that update and then add objects, as approved by the prompts'
+        objectType = syncPlan.objectType
+        callbackByKey = syncPlan.callbackByKey
+        newPacks = syncPlan.newPacks
+        callbackByKey.get('summarize_candidatePacks', lambda packs: None)(syncPlan.candidatePacks)
         # Update mismatches
-        callbackByKey.get('summarize_mismatches', lambda mismatches: None)(mismatches)
-        show_format_error = callbackByKey.get('show_format_error', lambda error: None)
-        for pack, oldPack in mismatches:
-            if callbackByKey.get('prompt_update', lambda pack, oldPack: False)(pack, oldPack):
-                modResult = update_result(pack, show_format_error)
-                for key in reversed(['ListID', 'TxnID', 'EditSequence']):
-                    rawResult = oldPack[objectType]
-                    if rawResult.get(key):
-                        modResult = OrderedDict([(key, rawResult[key])] + modResult.items())
-                self.call(objectType + 'ModRq', {objectType + 'Mod': modResult})
+        callbackByKey.get('summarize_mismatches', lambda mismatches: None)(syncPlan.mismatches)
+        yield self.format_modPacks(syncPlan)
         # Save newResults
         callbackByKey.get('summarize_newPacks', lambda packs: None)(newPacks)
         if not newPacks:
-            return 0
+            syncPlan.addCount = 0
+            return
         newResults = callbackByKey.get('collapse_packs', lambda packs: packs)(newPacks)
         if not callbackByKey.get('prompt_save', lambda newPacks, newResults: False)(newPacks, newResults):
             return
+        syncPlan.addCount = len(newPacks)
         format_result = callbackByKey.get('format_result', lambda result: result)
+        show_format_error = callbackByKey.get('show_format_error', lambda error: None)
+        addPacks = []
         for newResult in newResults:
-            self.call(objectType + 'AddRq', {objectType + 'Add': format_result(newResult, show_format_error)})
-        return len(newPacks)
+            addPacks.append((newResult, (objectType + 'AddRq', {objectType + 'Add': format_result(newResult, show_format_error)})))
+        yield addPacks
+
+    def format_modPacks(self, syncPlan):
+        'Return the (pack, (requestType, requestDictionary)) pairs that update the mismatches approved by prompt_update'
+        objectType = syncPlan.objectType
+        callbackByKey = syncPlan.callbackByKey
+        update_result = callbackByKey.get('update_result', lambda pack, show_format_error: {})
+        show_format_error = callbackByKey.get('show_format_error', lambda error: None)
+        prompt_update = callbackByKey.get('prompt_update', lambda pack, oldPack: False)
+        approvedMismatches = [(pack, oldPack) for pack, oldPack in syncPlan.mismatches if prompt_update(pack, oldPack)]
+        # Combine mismatches that modify the same object, such as lines of one bill, into one request
+        approvedMismatches = callbackByKey.get('collapse_mismatches', lambda mismatches: mismatches)(approvedMismatches)
+        modPacks = []
+        for pack, oldPack in approvedMismatches:
+            modResult = update_result(pack, show_format_error)
+            rawResult = oldPack[objectType]
+            for idKey in reversed(['ListID', 'TxnID', 'EditSequence']):
+                if rawResult.get(idKey):
+                    modResult = OrderedDict([(idKey, rawResult[idKey])] + modResult.items())
+            modPacks.append((pack, (objectType + 'ModRq', {objectType + 'Mod': modResult})))
+        return modPacks
+
+    def replan(self, syncPlan, objectIDs, batchSize=100):
+        'Match the mismatches of syncPlan on the given objects against their current state and return the Mods that update them'
+        objectType = syncPlan.objectType
+        callbackByKey = syncPlan.callbackByKey
+        objectIDs = set(objectIDs)
+        candidatePacks = [pack for pack, oldPack in syncPlan.mismatches if get_objectID(oldPack[objectType]) in objectIDs]
+        idKey = 'TxnID' if objectType in TRANSACTION_TYPES else 'ListID'
+        rawResults = []
+        for statusByKey, results in self.call_batch([(objectType + 'QueryRq', OrderedDict(
+            [(idKey, x)] + (syncPlan.requestDictionary or {}).items())) for x in sorted(objectIDs)], batchSize):
+            rawResults.extend(results)
+        # Leave out add_progress so that the candidates are not counted twice
+        replanCallbackByKey = dict(callbackByKey)
+        replanCallbackByKey.pop('add_progress', None)
+        freshPlan = self.plan(candidatePacks, objectType, replanCallbackByKey, syncPlan.requestDictionary, rawResults=rawResults)
+        # Candidates that no longer match, for example because their object was renamed or deleted, are left for the next run
+        show_save_error = callbackByKey.get('show_save_error', lambda pack, error: None)
+        for pack in freshPlan.newPacks:
+            show_save_error(pack, 'Could not update because it changed in QuickBooks and no longer matches')
+        return self.format_modPacks(freshPlan)
+
+    def save_batch(self, objectType, savePacks, show_save_error, batchSize=100, syncState=None, add_progress=None, replan_stale=None):
+        'Send (pack, (requestType, requestDictionary)) pairs in batches, cache saved objects and report failures by pack'
+        if not savePacks:
+            return
+        responsePacks = self.call_batch([request for pack, request in savePacks], batchSize, add_progress=add_progress)
+        savedResults = []
+        staleIDs = []
+        for (pack, (requestType, requestDictionary)), (statusByKey, results) in zip(savePacks, responsePacks):
+            if statusByKey.get('statusCode') == STATUS_CODE_STALE_EDIT_SEQUENCE and replan_stale:
+                staleIDs.append(get_objectID(requestDictionary[objectType + 'Mod']))
+            elif statusByKey.get('statusSeverity') == 'Error':
+                show_save_error(pack, statusByKey.get('statusMessage'))
+            else:
+                savedResults.extend(results)
+        # Record the new EditSequence of each saved object
+        if syncState and savedResults:
+            syncState.merge_snapshot('QuickBooks' + objectType, savedResults, get_objectID)
+        if not staleIDs:
+            return
+        # Someone modified these objects after we loaded them; resending our changes with a fresh EditSequence
+        # would overwrite that edit, so match them again against their current state and send the Mods that result
+        self.save_batch(objectType, replan_stale(staleIDs), show_save_error, batchSize, syncState, add_progress)
+
+
+class SyncPlan(object):
+    'Candidates matched against QuickBooks by QuickBooks.plan and waiting for QuickBooks.apply'
+
+    def __init__(self, objectType, callbackByKey, candidatePacks, mismatches, newPacks, requestDictionary=None):
+        self.objectType = objectType
+        self.callbackByKey = callbackByKey
+        self.candidatePacks = candidatePacks
+        self.mismatches = mismatches
+        self.newPacks = newPacks
+        # Query filters for loading the objects again when they change before they are written
+        self.requestDictionary = requestDictionary
+        # Number of candidates added, 0 if there were none or None if prompt_save declined them, once iter_savePacks ends
+        self.addCount = None
+
+
+def dispatch_requestProcessor():
+    'Return the QuickBooks RequestProcessor COM object'
+    # Import win32com here so that formatting and parsing QBXML does not need COM
+    from win32com.client import gencache
+    from pythoncom import CoInitialize
+    from pywintypes import com_error
+    CoInitialize() # Needed in case we are running in a separate thread
+    # EnsureDispatch generates the type library on first use and reuses it afterwards.
+    # You can check the generated type library for a list of dispatchable classes and their associated methods.
+    # The generated type library should be in site-packages/win32com/gen_py/
+    # e.g. /Python27/Lib/site-packages/win32com/gen_py/
+    try:
+        return gencache.EnsureDispatch('QBXMLRP2.RequestProcessor.1')
+    except com_error, error:
+        raise QuickBooksError('Could not access QuickBooks COM interface: %s' % error)
+
+
+def get_connectionErrors(requestProcessor):
+    'Return the exception classes that mean requestProcessor could not connect to QuickBooks'
+    errorClasses = [QBConnectionError]
+    # A substitute requestProcessor may declare the exception that it raises
+    errorClass = getattr(requestProcessor, 'error', None)
+    if errorClass:
+        errorClasses.append(errorClass)
+    # Import COM only after a connection fails so that a substitute requestProcessor works without it
+    try:
+        from pywintypes import com_error
+    except ImportError:
+        pass
+    else:
+        errorClasses.append(com_error)
+    return tuple(errorClasses)
+
+
+def get_objectID(result):
+    'Return ListID for list objects and TxnID for transactions'
+    return result.get('ListID') or result.get('TxnID')
 
 
 class QuickBooksError(Exception):
     pass
 
 
+class QBConnectionError(Exception):
+    pass
+
+
 class ParseSkip(Exception):
     pass
 
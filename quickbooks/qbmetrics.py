@@ -0,0 +1,87 @@
+'Count QuickBooks requests and measure where their time goes'
+import json
+from bisect import bisect_left
+from threading import Lock
+from collections import OrderedDict
+
+
+# Upper bounds of the latency histogram buckets in seconds; the last bucket counts slower calls
+LATENCY_BUCKET_SECONDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60]
+# Totals kept for each request type
+VALUE_KEYS = ['callCount', 'requestCount', 'requestBytes', 'responseBytes', 'formatSeconds', 'sendSeconds', 'parseSeconds']
+
+
+class QBMetrics(object):
+    'Totals and round trip latency histograms by request type, overall and for each task that sent requests'
+
+    def __init__(self):
+        self.lock = Lock()
+        # Name of the task sending requests, such as a pipeline stage; set it from the thread that owns the session
+        self.taskName = ''
+        self.statsByKey = {}
+
+    def record_call(self, requestType, requestCount, formatSeconds, sendSeconds, requestBytes, responseBytes):
+        'Record one round trip carrying requestCount requests'
+        bucketIndex = bisect_left(LATENCY_BUCKET_SECONDS, sendSeconds)
+        with self.lock:
+            for stats in self.get_stats(requestType):
+                stats['callCount'] += 1
+                stats['requestCount'] += requestCount
+                stats['requestBytes'] += requestBytes
+                stats['responseBytes'] += responseBytes
+                stats['formatSeconds'] += formatSeconds
+                stats['sendSeconds'] += sendSeconds
+                stats['sendSecondsMax'] = max(stats['sendSecondsMax'], sendSeconds)
+                stats['latencyCounts'][bucketIndex] += 1
+
+    def record_parse(self, requestType, parseSeconds):
+        'Record the time spent parsing a response'
+        with self.lock:
+            for stats in self.get_stats(requestType):
+                stats['parseSeconds'] += parseSeconds
+
+    def get_stats(self, requestType):
+        # Update the overall totals and those of the current task
+        statsList = []
+        for key in requestType, (self.taskName, requestType):
+            try:
+                stats = self.statsByKey[key]
+            except KeyError:
+                stats = self.statsByKey[key] = dict((x, 0) for x in VALUE_KEYS)
+                stats['sendSecondsMax'] = 0
+                stats['latencyCounts'] = [0] * (len(LATENCY_BUCKET_SECONDS) + 1)
+            statsList.append(stats)
+        return statsList
+
+    def get_summary(self):
+        'Return a dictionary of totals by request type and by task, ready for JSON'
+        with self.lock:
+            statsPacks = sorted(self.statsByKey.items())
+        summary = OrderedDict([
+            ('latencyBucketSeconds', LATENCY_BUCKET_SECONDS),
+            ('requestTypes', OrderedDict()),
+            ('tasks', OrderedDict()),
+        ])
+        for key, stats in statsPacks:
+            if isinstance(key, tuple):
+                taskName, requestType = key
+                summaryByRequestType = summary['tasks'].setdefault(taskName, OrderedDict())
+            else:
+                requestType = key
+                summaryByRequestType = summary['requestTypes']
+            summaryByRequestType[requestType] = format_stats(stats)
+        return summary
+
+    def save(self, path):
+        'Write the summary to path as JSON'
+        open(path, 'wt').write(json.dumps(self.get_summary(), indent=2))
+
+
+def format_stats(stats):
+    'Return stats in a fixed order with rounded seconds'
+    valueByKey = OrderedDict()
+    for key in VALUE_KEYS + ['sendSecondsMax']:
+        value = stats[key]
+        valueByKey[key] = round(value, 6) if key.endswith('Seconds') or key.endswith('SecondsMax') else value
+    valueByKey['latencyCounts'] = list(stats['latencyCounts'])
+    return valueByKey
@@ -0,0 +1,231 @@
+'Typed records for the QBXML responses used during synchronization'
+import datetime
+from decimal import Decimal
+
+from quickbooks.qbxml import parse_response_part
+
+
+class Record(object):
+    'Compact QBXML record that supports the dictionary lookups of parse_response_part'
+
+    __slots__ = ('extraByKey',)
+    # Map field to converter for known fields
+    converterByKey = {}
+    # Fields that are always lists, even if they appear once or not at all
+    listKeys = ()
+
+    def __init__(self):
+        self.extraByKey = None
+
+    @classmethod
+    def decode(Class, part):
+        'Decode element into record'
+        record = Class()
+        for key in Class.listKeys:
+            setattr(record, key, [])
+        converterByKey = Class.converterByKey
+        for element in part:
+            key = element.tag
+            convert = converterByKey.get(key)
+            if not convert:
+                if record.extraByKey is None:
+                    record.extraByKey = {}
+                extraByKey = record.extraByKey
+                content = parse_response_part(element)
+                if key in extraByKey:
+                    oldValue = extraByKey[key]
+                    if type(oldValue) is not list:
+                        oldValue = extraByKey[key] = [oldValue]
+                    oldValue.append(content)
+                else:
+                    extraByKey[key] = content
+            elif key in Class.listKeys:
+                getattr(record, key).append(convert(element))
+            else:
+                setattr(record, key, convert(element))
+        return record
+
+    def __getitem__(self, key):
+        if key in self.converterByKey:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extraByKey and key in self.extraByKey:
+            return self.extraByKey[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.converterByKey:
+            setattr(self, key, value)
+        else:
+            if self.extraByKey is None:
+                self.extraByKey = {}
+            self.extraByKey[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        for key in self.converterByKey:
+            try:
+                yield key, getattr(self, key)
+            except AttributeError:
+                pass
+        if self.extraByKey:
+            for item in self.extraByKey.iteritems():
+                yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [key for key, value in self.iteritems()]
+
+    def __eq__(self, other):
+        return hasattr(other, 'iteritems') and dict(self.iteritems()) == dict(other.iteritems())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __getstate__(self):
+        return dict(self.iteritems())
+
+    def __setstate__(self, valueByKey):
+        self.extraByKey = None
+        for key, value in valueByKey.iteritems():
+            self[key] = value
+
+
+def decode_text(element):
+    return element.text
+
+
+def decode_integer(element):
+    return int(element.text)
+
+
+def decode_decimal(element):
+    return Decimal(element.text)
+
+
+def decode_date(element):
+    text = element.text
+    return datetime.date(int(text[0:4]), int(text[5:7]), int(text[8:10]))
+
+
+def decode_boolean(element):
+    return element.text == 'true'
+
+
+class RefRecord(Record):
+    'Reference to a list object such as VendorRef or CustomerRef'
+
+    __slots__ = ('ListID', 'FullName')
+    converterByKey = dict.fromkeys(__slots__, decode_text)
+
+
+def decode_ref(element):
+    return RefRecord.decode(element)
+
+
+LIST_CONVERTER_BY_KEY = {
+    'ListID': decode_text,
+    'TimeCreated': decode_text,
+    'TimeModified': decode_text,
+    'EditSequence': decode_text,
+    'Name': decode_text,
+    'FullName': decode_text,
+    'IsActive': decode_boolean,
+}
+
+
+class VendorRecord(Record):
+
+    __slots__ = ('ListID', 'TimeCreated', 'TimeModified', 'EditSequence', 'Name', 'FullName', 'IsActive', 'CompanyName')
+    converterByKey = dict(LIST_CONVERTER_BY_KEY, CompanyName=decode_text)
+
+
+class CustomerRecord(Record):
+
+    __slots__ = ('ListID', 'TimeCreated', 'TimeModified', 'EditSequence', 'Name', 'FullName', 'IsActive', 'ParentRef', 'Sublevel')
+    converterByKey = dict(LIST_CONVERTER_BY_KEY, ParentRef=decode_ref, Sublevel=decode_integer)
+
+
+class AccountRecord(Record):
+
+    __slots__ = ('ListID', 'TimeCreated', 'TimeModified', 'EditSequence', 'Name', 'FullName', 'IsActive', 'ParentRef', 'Sublevel', 'AccountType', 'AccountNumber', 'Balance', 'TotalBalance')
+    converterByKey = dict(LIST_CONVERTER_BY_KEY,
+        ParentRef=decode_ref,
+        Sublevel=decode_integer,
+        AccountType=decode_text,
+        AccountNumber=decode_text,
+        Balance=decode_decimal,
+        TotalBalance=decode_decimal)
+
+
+class ExpenseLineRecord(Record):
+
+    __slots__ = ('TxnLineID', 'AccountRef', 'Amount', 'Memo', 'CustomerRef', 'ClassRef', 'BillableStatus')
+    converterByKey = {
+        'TxnLineID': decode_text,
+        'AccountRef': decode_ref,
+        'Amount': decode_decimal,
+        'Memo': decode_text,
+        'CustomerRef': decode_ref,
+        'ClassRef': decode_ref,
+        'BillableStatus': decode_text,
+    }
+
+
+class BillRecord(Record):
+
+    __slots__ = ('TxnID', 'TimeCreated', 'TimeModified', 'EditSequence', 'TxnNumber', 'VendorRef', 'APAccountRef', 'TxnDate', 'DueDate', 'AmountDue', 'RefNumber', 'Memo', 'IsPaid', 'ExpenseLineRet', 'ItemLineRet')
+    converterByKey = {
+        'TxnID': decode_text,
+        'TimeCreated': decode_text,
+        'TimeModified': decode_text,
+        'EditSequence': decode_text,
+        'TxnNumber': decode_integer,
+        'VendorRef': decode_ref,
+        'APAccountRef': decode_ref,
+        'TxnDate': decode_date,
+        'DueDate': decode_date,
+        'AmountDue': decode_decimal,
+        'RefNumber': decode_text,
+        'Memo': decode_text,
+        'IsPaid': decode_boolean,
+        'ExpenseLineRet': ExpenseLineRecord.decode,
+        'ItemLineRet': parse_response_part,
+    }
+    listKeys = ('ExpenseLineRet', 'ItemLineRet')
+
+
+recordClassByTag = {
+    'VendorRet': VendorRecord,
+    'CustomerRet': CustomerRecord,
+    'AccountRet': AccountRecord,
+    'BillRet': BillRecord,
+    'ExpenseLineRet': ExpenseLineRecord,
+}
+
+
+def decode_response_part(part):
+    'Decode response part into a typed record if its tag is known'
+    Class = recordClassByTag.get(part.tag)
+    if not Class:
+        return parse_response_part(part)
+    return Class.decode(part)
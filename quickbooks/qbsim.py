@@ -0,0 +1,333 @@
+'In-process simulator of the QBXML RequestProcessor COM interface'
+import copy
+import time
+import datetime
+from decimal import Decimal
+from collections import OrderedDict
+from xml.etree import ElementTree as xml
+
+
+# Objects that have a ListID and a unique FullName
+LIST_TYPES = ['Vendor', 'Customer', 'Account']
+# Objects that have a TxnID and lines
+TRANSACTION_TYPES = ['Bill']
+# Map reference tag to the list type that it refers to
+REF_TYPE_BY_TAG = {
+    'VendorRef': 'Vendor',
+    'CustomerRef': 'Customer',
+    'ParentRef': 'Customer',
+    'AccountRef': 'Account',
+    'APAccountRef': 'Account',
+}
+
+
+class RequestProcessor(object):
+    'Stand-in for QBXMLRP2.RequestProcessor that keeps Vendor, Customer, Account and Bill objects in memory'
+
+    def __init__(self, latency=0, timeStart=datetime.datetime(2011, 1, 1)):
+        # Seconds to wait per ProcessRequest to imitate a round trip to QuickBooks
+        self.latency = latency
+        self.time = timeStart
+        self.objectCount = 0
+        self.requestCount = 0
+        self.objectByIDByType = dict((x, OrderedDict()) for x in LIST_TYPES + TRANSACTION_TYPES)
+        self.listIDByFullNameByType = dict((x, {}) for x in LIST_TYPES)
+        self.iteratorCount = 0
+        self.objectIDsByIteratorID = {}
+        # Exception raised for requests that QuickBooks would reject, which QuickBooks.connect also catches
+        self.error = SimulatorError
+
+    def OpenConnection2(self, applicationID, applicationName, connectionType):
+        pass
+
+    def BeginSession(self, companyFileName, fileMode):
+        return 'simulator'
+
+    def EndSession(self, ticket):
+        pass
+
+    def CloseConnection(self):
+        pass
+
+    def ProcessRequest(self, ticket, request):
+        'Process each section of a QBXML request and return the QBXML response'
+        self.requestCount += 1
+        if self.latency:
+            time.sleep(self.latency)
+        body = xml.XML(request).find('QBXMLMsgsRq')
+        stopOnError = body.get('onError') == 'stopOnError'
+        responseBody = xml.Element('QBXMLMsgsRs')
+        for section in body:
+            responseSection = self.process_section(section)
+            responseBody.append(responseSection)
+            if stopOnError and responseSection.get('statusSeverity') == 'Error':
+                break
+        document = xml.Element('QBXML')
+        document.append(responseBody)
+        # Return unicode as the COM interface does
+        return ('<?xml version="1.0" ?>' + xml.tostring(document, encoding='utf-8')).decode('utf-8')
+
+    def process_section(self, section):
+        'Dispatch request section by type and wrap the result in a response section'
+        requestType = section.tag
+        for suffix in 'QueryRq', 'AddRq', 'ModRq':
+            if requestType.endswith(suffix):
+                objectType = requestType[:-len(suffix)]
+                break
+        else:
+            objectType, suffix = None, None
+        responseSection = xml.Element(requestType[:-2] + 'Rs', requestID=section.get('requestID', ''))
+        if objectType not in self.objectByIDByType:
+            set_status(responseSection, '1', 'Error', 'Request %s is not supported by the simulator' % requestType)
+            return responseSection
+        try:
+            if suffix == 'QueryRq':
+                self.query(objectType, section, responseSection)
+            elif suffix == 'AddRq':
+                responseSection.append(self.add(objectType, section.find(objectType + 'Add')))
+            else:
+                responseSection.append(self.mod(objectType, section.find(objectType + 'Mod')))
+        except SimulatorError, error:
+            statusCode, statusMessage = error.args
+            set_status(responseSection, statusCode, 'Error', statusMessage)
+        else:
+            if responseSection.get('statusCode') is None:
+                set_status(responseSection, '0', 'Info', 'Status OK')
+        return responseSection
+
+    def query(self, objectType, section, responseSection):
+        'Append matching objects, continuing an iterator if requested'
+        iterator = section.get('iterator')
+        if iterator == 'Continue':
+            iteratorID = section.get('iteratorID')
+            try:
+                objectIDs = self.objectIDsByIteratorID[iteratorID]
+            except KeyError:
+                raise SimulatorError('3170', 'The iterator %s has expired or does not exist' % iteratorID)
+        else:
+            objectIDs = self.find(objectType, section)
+        maxReturned = section.findtext('MaxReturned')
+        pageSize = int(maxReturned) if maxReturned else len(objectIDs)
+        includeLineItems = section.findtext('IncludeLineItems') in ('1', 'true')
+        objectByID = self.objectByIDByType[objectType]
+        pageIDs, objectIDs = objectIDs[:pageSize], objectIDs[pageSize:]
+        for objectID in pageIDs:
+            element = objectByID.get(objectID)
+            if element is None:
+                continue
+            if objectType in TRANSACTION_TYPES and not includeLineItems:
+                header = xml.Element(element.tag)
+                header.extend(x for x in element if not x.tag.endswith('LineRet'))
+                element = header
+            responseSection.append(element)
+        if iterator:
+            if iterator == 'Start':
+                self.iteratorCount += 1
+                iteratorID = '{%08i-0000-0000-0000-000000000000}' % self.iteratorCount
+            if objectIDs:
+                self.objectIDsByIteratorID[iteratorID] = objectIDs
+            else:
+                self.objectIDsByIteratorID.pop(iteratorID, None)
+            responseSection.set('iteratorRemainingCount', str(len(objectIDs)))
+            responseSection.set('iteratorID', iteratorID)
+        if not pageIDs:
+            set_status(responseSection, '1', 'Info', 'A query request did not find a matching object in QuickBooks')
+
+    def find(self, objectType, section):
+        'Return IDs of objects that match the query filters'
+        objectByID = self.objectByIDByType[objectType]
+        idKey = 'ListID' if objectType in LIST_TYPES else 'TxnID'
+        objectIDs = [x.text for x in section.findall(idKey)]
+        if objectIDs:
+            return [x for x in objectIDs if x in objectByID]
+        fullNames = [x.text for x in section.findall('FullName')]
+        if fullNames:
+            listIDByFullName = self.listIDByFullNameByType[objectType]
+            return [listIDByFullName[x] for x in fullNames if x in listIDByFullName]
+        fromModifiedDate = section.findtext('FromModifiedDate') or section.findtext('ModifiedDateRangeFilter/FromModifiedDate')
+        if fromModifiedDate:
+            fromModifiedDate = fromModifiedDate[:19]
+            return [x for x, y in objectByID.iteritems() if y.findtext('TimeModified')[:19] >= fromModifiedDate]
+        return objectByID.keys()
+
+    def add(self, objectType, part):
+        'Create object and return its Ret element'
+        if part is None:
+            raise SimulatorError('3000', 'The request does not contain %sAdd' % objectType)
+        timeText, editSequence = self.tick()
+        element = xml.Element(objectType + 'Ret')
+        if objectType in LIST_TYPES:
+            objectID = '%X-%s' % (0x80000000 + self.next_count(), editSequence)
+            append_text(element, 'ListID', objectID)
+        else:
+            objectID = '%i-%s' % (self.next_count(), editSequence)
+            append_text(element, 'TxnID', objectID)
+        append_text(element, 'TimeCreated', timeText)
+        append_text(element, 'TimeModified', timeText)
+        append_text(element, 'EditSequence', editSequence)
+        if objectType in TRANSACTION_TYPES:
+            append_text(element, 'TxnNumber', str(self.objectCount))
+        for child in part:
+            if child.tag.endswith('LineAdd'):
+                element.append(self.make_line(child, child.tag[:-3] + 'Ret'))
+            else:
+                element.append(self.resolve(child))
+        if objectType in LIST_TYPES:
+            self.set_fullName(objectType, element)
+        else:
+            self.set_amountDue(element)
+        self.objectByIDByType[objectType][objectID] = element
+        return element
+
+    def mod(self, objectType, part):
+        'Update object if its EditSequence is current and return its Ret element'
+        if part is None:
+            raise SimulatorError('3000', 'The request does not contain %sMod' % objectType)
+        idKey = 'ListID' if objectType in LIST_TYPES else 'TxnID'
+        objectID = part.findtext(idKey)
+        try:
+            oldElement = self.objectByIDByType[objectType][objectID]
+        except KeyError:
+            raise SimulatorError('3120', 'Object "%s" specified in the request cannot be found' % objectID)
+        if part.findtext('EditSequence') != oldElement.findtext('EditSequence'):
+            raise SimulatorError('3200', 'The provided edit sequence "%s" is out-of-date' % part.findtext('EditSequence'))
+        # Build the new version before changing anything so that a failed Mod leaves the object alone
+        element = copy.deepcopy(oldElement)
+        lineMods = []
+        for child in part:
+            if child.tag in (idKey, 'EditSequence'):
+                continue
+            if child.tag.endswith('LineMod'):
+                lineMods.append(child)
+                continue
+            oldChild = element.find(child.tag)
+            newChild = self.resolve(child)
+            if oldChild is None:
+                element.append(newChild)
+            else:
+                element[list(element).index(oldChild)] = newChild
+        if lineMods:
+            # Lines that are not mentioned are deleted
+            oldLineByID = dict((x.findtext('TxnLineID'), x) for x in element if x.tag.endswith('LineRet'))
+            for line in [x for x in element if x.tag.endswith('LineRet')]:
+                element.remove(line)
+            for lineMod in lineMods:
+                lineTag = lineMod.tag[:-3] + 'Ret'
+                txnLineID = lineMod.findtext('TxnLineID')
+                if txnLineID == '-1':
+                    element.append(self.make_line(lineMod, lineTag))
+                    continue
+                try:
+                    line = oldLineByID[txnLineID]
+                except KeyError:
+                    raise SimulatorError('3120', 'Line "%s" specified in the request cannot be found' % txnLineID)
+                for lineChild in lineMod:
+                    oldLineChild = line.find(lineChild.tag)
+                    newLineChild = self.resolve(lineChild)
+                    if oldLineChild is None:
+                        line.append(newLineChild)
+                    else:
+                        line[list(line).index(oldLineChild)] = newLineChild
+                element.append(line)
+        if objectType in LIST_TYPES:
+            self.set_fullName(objectType, element, oldElement.findtext('FullName'))
+        else:
+            self.set_amountDue(element)
+        timeText, editSequence = self.tick()
+        element.find('TimeModified').text = timeText
+        element.find('EditSequence').text = editSequence
+        self.objectByIDByType[objectType][objectID] = element
+        return element
+
+    def make_line(self, part, tag):
+        'Return line with a new TxnLineID'
+        line = xml.Element(tag)
+        append_text(line, 'TxnLineID', '%i-%s' % (self.next_count(), self.tick()[1]))
+        for child in part:
+            if child.tag != 'TxnLineID':
+                line.append(self.resolve(child))
+        return line
+
+    def resolve(self, element):
+        'Fill in the ListID of a reference by FullName or complain if the reference is invalid'
+        refType = REF_TYPE_BY_TAG.get(element.tag)
+        if not refType:
+            return element
+        listID = element.findtext('ListID')
+        fullName = element.findtext('FullName')
+        objectByID = self.objectByIDByType[refType]
+        if not listID:
+            listID = self.listIDByFullNameByType[refType].get(fullName)
+        if listID not in objectByID:
+            raise SimulatorError('3140', 'There is an invalid reference to QuickBooks %s "%s"' % (refType, fullName or listID))
+        element.clear()
+        append_text(element, 'ListID', listID)
+        append_text(element, 'FullName', objectByID[listID].findtext('FullName'))
+        return element
+
+    def set_fullName(self, objectType, element, oldFullName=None):
+        'Derive FullName and Sublevel from Name and ParentRef and keep FullNames unique'
+        parentRef = element.find('ParentRef')
+        name = element.findtext('Name')
+        if parentRef is None:
+            fullName, sublevel = name, 0
+        else:
+            parent = self.objectByIDByType[objectType][parentRef.findtext('ListID')]
+            fullName, sublevel = parent.findtext('FullName') + ':' + name, int(parent.findtext('Sublevel') or 0) + 1
+        listIDByFullName = self.listIDByFullNameByType[objectType]
+        if fullName != oldFullName and fullName in listIDByFullName:
+            raise SimulatorError('3100', 'The name "%s" of the list element is already in use' % fullName)
+        valuePacks = [('FullName', fullName)]
+        if objectType != 'Vendor':
+            valuePacks.append(('Sublevel', str(sublevel)))
+        for key, value in valuePacks:
+            child = element.find(key)
+            if child is None:
+                append_text(element, key, value)
+            else:
+                child.text = value
+        if oldFullName is not None and fullName != oldFullName:
+            del listIDByFullName[oldFullName]
+            # Renaming a parent renames its children
+            oldPrefix = oldFullName + ':'
+            for child in self.objectByIDByType[objectType].values():
+                childFullName = child.findtext('FullName')
+                if childFullName.startswith(oldPrefix):
+                    newChildFullName = fullName + ':' + childFullName[len(oldPrefix):]
+                    del listIDByFullName[childFullName]
+                    listIDByFullName[newChildFullName] = child.findtext('ListID')
+                    child.find('FullName').text = newChildFullName
+        listIDByFullName[fullName] = element.findtext('ListID')
+
+    def set_amountDue(self, element):
+        'Total line amounts'
+        amountDue = sum((Decimal(x.findtext('Amount') or 0) for x in element if x.tag.endswith('LineRet')), Decimal(0))
+        child = element.find('AmountDue')
+        if child is None:
+            child = append_text(element, 'AmountDue', '')
+        child.text = '%.2f' % amountDue
+
+    def tick(self):
+        'Advance the clock and return (TimeModified, EditSequence)'
+        self.time += datetime.timedelta(seconds=1)
+        return self.time.strftime('%Y-%m-%dT%H:%M:%S-05:00'), str(int(time.mktime(self.time.timetuple())))
+
+    def next_count(self):
+        self.objectCount += 1
+        return self.objectCount
+
+
+def set_status(section, statusCode, statusSeverity, statusMessage):
+    section.set('statusCode', statusCode)
+    section.set('statusSeverity', statusSeverity)
+    section.set('statusMessage', statusMessage)
+
+
+def append_text(element, key, text):
+    child = xml.SubElement(element, key)
+    child.text = text
+    return child
+
+
+class SimulatorError(Exception):
+    pass
@@ -0,0 +1,163 @@
+'Trace QBXML requests and responses to compressed rotating files from a background thread'
+import os
+import gzip
+import json
+import time
+import zlib
+import datetime
+from Queue import Queue, Full
+from threading import Thread
+from collections import OrderedDict
+
+
+# Trace files are named by the time that they were opened so that they sort in order
+FILE_PREFIX = 'qbxml-'
+FILE_EXTENSION = '.jsonl.gz'
+# Start a new file when the current one reaches this many compressed bytes or this age in seconds
+FILE_BYTES_MAX = 64 * 1024 * 1024
+FILE_SECONDS_MAX = 24 * 60 * 60
+# Delete the oldest files beyond this count so that a trace folder stays under FILE_COUNT_MAX * FILE_BYTES_MAX
+FILE_COUNT_MAX = 20
+# Number of exchanges waiting for the writer; beyond this, exchanges are dropped rather than slowing the session
+QUEUE_SIZE_MAX = 1000
+# Number of compressed bytes to read at a time when replaying a trace
+READ_BYTES = 1024 * 1024
+
+
+class QBTrace(object):
+    'Append request and response pairs with their timings to gzipped JSON Lines files'
+
+    def __init__(self, folderPath, fileBytesMax=FILE_BYTES_MAX, fileSecondsMax=FILE_SECONDS_MAX, fileCountMax=FILE_COUNT_MAX):
+        if not os.path.exists(folderPath):
+            os.makedirs(folderPath)
+        self.folderPath = folderPath
+        self.fileBytesMax = fileBytesMax
+        self.fileSecondsMax = fileSecondsMax
+        self.fileCountMax = fileCountMax
+        self.queue = Queue(QUEUE_SIZE_MAX)
+        # Exchanges dropped because the writer fell behind, reported in the next record written
+        self.droppedCount = 0
+        # The last error that stopped the writer from saving an exchange
+        self.error = None
+        self.traceFile = None
+        self.timeOpened = None
+        self.thread = Thread(target=self.run)
+        # Do not keep the program alive for the trace; call flush or close to finish writing
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, taskName, requestType, requestCount, sendSeconds, request, response):
+        'Queue an exchange for the writer without waiting for it'
+        try:
+            self.queue.put_nowait((time.time(), taskName, requestType, requestCount, sendSeconds, request, response))
+        except Full:
+            self.droppedCount += 1
+
+    def flush(self):
+        'Wait until every queued exchange is written and readable on disk'
+        self.queue.join()
+
+    def close(self):
+        'Write queued exchanges, close the current file and stop the writer'
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    self.close_file()
+                    return
+                self.save(item)
+                # Make the file readable up to here whenever the writer catches up
+                if self.queue.empty():
+                    self.traceFile.flush(zlib.Z_SYNC_FLUSH)
+            # Keep draining the queue so that the session never waits on a broken trace
+            except (IOError, OSError, ValueError), error:
+                self.error = error
+                self.close_file()
+            finally:
+                self.queue.task_done()
+
+    def save(self, item):
+        timeSent, taskName, requestType, requestCount, sendSeconds, request, response = item
+        if self.traceFile and (
+            self.traceFile.fileobj.tell() >= self.fileBytesMax or
+            time.time() - self.timeOpened >= self.fileSecondsMax):
+            self.close_file()
+        if not self.traceFile:
+            self.open_file()
+        droppedCount, self.droppedCount = self.droppedCount, 0
+        request, requestEncoding = decode_text(request)
+        response, responseEncoding = decode_text(response)
+        self.traceFile.write(json.dumps(OrderedDict([
+            ('time', datetime.datetime.fromtimestamp(timeSent).isoformat()),
+            ('task', taskName),
+            ('requestType', requestType),
+            ('requestCount', requestCount),
+            ('sendSeconds', round(sendSeconds, 6)),
+            ('droppedCount', droppedCount),
+            ('request', request),
+            ('requestEncoding', requestEncoding),
+            ('response', response),
+            ('responseEncoding', responseEncoding),
+        ]), separators=(',', ':')) + '\n')
+
+    def open_file(self):
+        # Delete the oldest files to leave room for the new one
+        for path in find_tracePaths(self.folderPath)[:-self.fileCountMax + 1 or None]:
+            os.remove(path)
+        now = datetime.datetime.now()
+        fileName = FILE_PREFIX + now.strftime('%Y%m%d-%H%M%S') + '-%06i' % now.microsecond + FILE_EXTENSION
+        self.traceFile = gzip.open(os.path.join(self.folderPath, fileName), 'wb')
+        self.timeOpened = time.time()
+
+    def close_file(self):
+        if not self.traceFile:
+            return
+        try:
+            self.traceFile.close()
+        finally:
+            self.traceFile = None
+
+
+def decode_text(text):
+    'Return text as unicode for JSON and the encoding that restores its original bytes, if any'
+    if isinstance(text, unicode):
+        return text, None
+    # Responses are not always valid UTF-8; latin-1 maps every byte to a character so that none are lost
+    for encoding in 'utf-8', 'latin-1':
+        try:
+            return text.decode(encoding), encoding
+        except UnicodeDecodeError:
+            pass
+
+
+def find_tracePaths(folderPath):
+    'Return the paths of trace files in folderPath from oldest to newest'
+    return [os.path.join(folderPath, x) for x in sorted(os.listdir(folderPath)) if x.startswith(FILE_PREFIX) and x.endswith(FILE_EXTENSION)]
+
+
+def iter_trace(path):
+    'Yield exchanges from a trace file or a folder of trace files in order, including files still being written'
+    for tracePath in find_tracePaths(path) if os.path.isdir(path) else [path]:
+        # Decompress with zlib because gzip drops the data buffered before a missing end of file
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        traceFile = open(tracePath, 'rb')
+        text = ''
+        try:
+            for chunk in iter(lambda: traceFile.read(READ_BYTES), ''):
+                lines = (text + decompressor.decompress(chunk)).split('\n')
+                # Keep the unfinished last line for the next chunk
+                text = lines.pop()
+                for line in lines:
+                    exchange = json.loads(line, object_pairs_hook=OrderedDict)
+                    # Restore the bytes that were sent and received
+                    for key in 'request', 'response':
+                        encoding = exchange.get(key + 'Encoding')
+                        if encoding:
+                            exchange[key] = exchange[key].encode(encoding)
+                    yield exchange
+        finally:
+            traceFile.close()
@@ -1,14 +1,130 @@
 'Functions for formatting and parsing QBXML'
+from cStringIO import StringIO
 from xml.etree import ElementTree as xml
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 
 
-def format_request(requestType, requestDictionary, qbxmlVersion, onError):
-    'Format request as QBXML'
-    section = xml.Element(requestType, requestID='1')
+# Envelope before and after the request sections by (qbxmlVersion, onError)
+envelopeByKey = {}
+
+
+def format_request(requestType, requestDictionary, qbxmlVersion, onError, requestAttributes=None):
+    'Format request as QBXML, writing the same bytes as format_request_tree without building elements'
+    parts = []
+    write_request_element(parts, requestType, requestDictionary.iteritems(), dict(requestAttributes or {}, requestID='1'))
+    return join_request_document(parts, qbxmlVersion, onError)
+
+
+def format_batch_request(requestPacks, qbxmlVersion, onError):
+    'Format (requestType, requestDictionary) pairs as one QBXML document with requestIDs 1..N'
+    parts = []
+    for requestIndex, (requestType, requestDictionary) in enumerate(requestPacks):
+        write_request_element(parts, requestType, requestDictionary.iteritems(), {'requestID': str(requestIndex + 1)})
+    return join_request_document(parts, qbxmlVersion, onError)
+
+
+def join_request_document(parts, qbxmlVersion, onError):
+    'Wrap request parts in a cached QBXML envelope'
+    if not parts:
+        return format_request_document([], qbxmlVersion, onError)
+    try:
+        prefix, suffix = envelopeByKey[qbxmlVersion, onError]
+    except KeyError:
+        # Cut the envelope around a placeholder section so that it matches format_request_document
+        prefix, suffix = envelopeByKey[qbxmlVersion, onError] = format_request_document([xml.Element('_')], qbxmlVersion, onError).split('<_ />')
+    document = prefix + ''.join(parts) + suffix
+    # ElementTree writes unicode tags and values as UTF-8
+    return document.encode('utf-8') if isinstance(document, unicode) else document
+
+
+def write_request_element(parts, tag, items, attributes=None):
+    'Append the parts of an element whose children are (key, value) pairs'
+    attributeText = ''.join(' %s="%s"' % (x, escape_attribute(y)) for x, y in sorted(attributes.items())) if attributes else ''
+    # Reserve a place for the start tag, which closes itself if there are no children
+    parts.append(None)
+    partIndex = len(parts)
+    for key, value in items:
+        write_request_part(parts, key, value)
+    if len(parts) == partIndex:
+        parts[partIndex - 1] = '<%s%s />' % (tag, attributeText)
+    else:
+        parts[partIndex - 1] = '<%s%s>' % (tag, attributeText)
+        parts.append('</%s>' % tag)
+
+
+def write_request_part(parts, key, value):
+    'Append the parts of a request part recursively, treating values as format_request_part does'
+    # Check for the most common value first
+    if value.__class__ is not str:
+        # If value is a dictionary,
+        if hasattr(value, 'iteritems'):
+            write_request_element(parts, key, value.iteritems())
+            return
+        # If value is a list of dictionaries,
+        elif hasattr(value, '__iter__'):
+            for valueByKey in value:
+                write_request_element(parts, key, valueByKey.iteritems())
+            return
+        # Keep unicode so that join_request_document encodes it as UTF-8
+        elif value.__class__ is not unicode:
+            value = str(value)
+    # If value is neither a dictionary nor a list,
+    if value:
+        parts.append('<%s>%s</%s>' % (key, escape_text(value), key))
+    else:
+        parts.append('<%s />' % key)
+
+
+def escape_text(text):
+    'Escape character data as ElementTree does'
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def escape_attribute(text):
+    'Escape an attribute value as ElementTree does'
+    text = escape_text(text)
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    return text
+
+
+def format_request_tree(requestType, requestDictionary, qbxmlVersion, onError, requestAttributes=None):
+    'Format request as QBXML by building an ElementTree'
+    section = format_request_section(requestType, requestDictionary, '1', requestAttributes)
+    return format_request_document([section], qbxmlVersion, onError)
+
+
+def format_batch_request_tree(requestPacks, qbxmlVersion, onError):
+    'Format (requestType, requestDictionary) pairs as one QBXML document with requestIDs 1..N by building an ElementTree'
+    sections = []
+    for requestIndex, (requestType, requestDictionary) in enumerate(requestPacks):
+        sections.append(format_request_section(requestType, requestDictionary, str(requestIndex + 1)))
+    return format_request_document(sections, qbxmlVersion, onError)
+
+
+def format_request_section(requestType, requestDictionary, requestID, requestAttributes=None):
+    'Format request section'
+    section = xml.Element(requestType, requestAttributes or {}, requestID=requestID)
     for key, value in requestDictionary.iteritems():
         section.extend(format_request_part(key, value))
+    return section
+
+
+def format_request_document(sections, qbxmlVersion, onError):
+    'Wrap request sections in a QBXML envelope'
     body = xml.Element('QBXMLMsgsRq', onError=onError)
-    body.append(section)
+    body.extend(sections)
     document = xml.Element('QBXML')
     document.append(body)
     elements = [
@@ -39,26 +155,70 @@ def format_request_part(key, value):
     # If value is neither a dictionary nor a list,
     else:
         part = xml.Element(key)
-        part.text = str(value)
+        part.text = value if isinstance(value, unicode) else str(value)
         return [part]
 
 
 def parse_response(response):
     'Parse QBXML response into a list of dictionaries'
-    document = xml.XML(response)
-    body = document[0]
-    section = body[0]
-    valueByKeys = []
-    for part in section:
-        valueByKeys.append(parse_response_part(part))
+    statusByKey, valueByKeys = parse_response_section(response)
     if not valueByKeys:
-        raise Exception(section.get('statusMessage'))
+        raise Exception(statusByKey.get('statusMessage'))
     return valueByKeys
 
 
+def parse_response_section(response):
+    'Parse QBXML response into its status attributes and a list of dictionaries'
+    statusByKey = {}
+    valueByKeys = list(iter_response(response, statusByKey))
+    return statusByKey, valueByKeys
+
+
+def iter_response(response, statusByKey=None, parse_part=None):
+    'Parse QBXML response incrementally, yielding one dictionary per record'
+    parse_part = parse_part or parse_response_part
+    if isinstance(response, unicode):
+        response = response.encode('utf-8')
+    depth = 0
+    # QBXML > QBXMLMsgsRs > *Rs > *Ret
+    for event, element in iterparse(StringIO(response), events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 3:
+                section = element
+                if statusByKey is not None:
+                    statusByKey.update(element.attrib)
+            continue
+        depth -= 1
+        if depth == 3:
+            yield parse_part(element)
+            # Drop the record so that memory stays bounded by one record
+            del section[:]
+        elif depth == 2:
+            # Only the first section is parsed
+            break
+
+
+def parse_batch_response(response, parse_part=None):
+    'Parse QBXML response into (status attributes, list of dictionaries) by requestID'
+    parse_part = parse_part or parse_response_part
+    # COM returns unicode, which ElementTree would encode as ASCII
+    if isinstance(response, unicode):
+        response = response.encode('utf-8')
+    document = xml.XML(response)
+    body = document[0]
+    packByRequestID = {}
+    for section in body:
+        valueByKeys = []
+        for part in section:
+            valueByKeys.append(parse_part(part))
+        packByRequestID[section.get('requestID')] = dict(section.attrib), valueByKeys
+    return packByRequestID
+
+
 def parse_response_part(part):
     'Parse response part recursively'
-    if not part.getchildren():
+    if not len(part):
         return part.text
     valueByKey = {}
     for element in part:
@@ -66,7 +226,7 @@ def parse_response_part(part):
         content = parse_response_part(element)
         if key in valueByKey:
             oldValue = valueByKey[key]
-            newValue = oldValue if hasattr(oldValue, 'append') else [oldValue]
+            newValue = oldValue if type(oldValue) is list else [oldValue]
             newValue.append(content)
         else:
             newValue = content
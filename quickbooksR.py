@@ -1,5 +1,4 @@
 import re
-import datetime
 from collections import OrderedDict, defaultdict
 
 from quickbooks import ParseSkip, ParseError, MismatchError
@@ -20,6 +19,16 @@ class QBRosetta(object):
         self.lawFirmByID = dict((x['id'], x) for x in lawFirms)
         self.lawFirmByName = dict((x['name'].lower(), x) for x in lawFirms)
         self.countryByID = dict((x['id'], x) for x in countries)
+        # Job names are truncated, so index countries by every prefix of their name
+        self.countryByNamePrefix = {}
+        for country in sorted(countries, key=lambda x: (x['name'].lower(), x['id'])):
+            countryName = country['name'].lower()
+            for prefixLength in xrange(1, len(countryName) + 1):
+                self.countryByNamePrefix.setdefault(countryName[:prefixLength], country)
+        # Map id(record) to (fields, canonicalPack) so that each record is formatted and parsed once
+        self.canonicalTechnologyByID = {}
+        self.canonicalPatentByID = {}
+        self.canonicalLawFirmByID = {}
 
 
     # Customer
@@ -50,18 +59,33 @@ class QBRosetta(object):
 
     def equal_technology(self, technology1, technology2):
         try:
-            technology1 = self.parse_customer(self.format_customer(technology1))
-            technology2 = self.parse_customer(self.format_customer(technology2))
+            technology1 = self.get_canonical_technology(technology1)
+            technology2 = self.get_canonical_technology(technology2)
         except RosettaError:
             return False
-        if technology1['case'].lower() != technology2['case'].lower():
+        if technology1[0] != technology2[0]:
             return False
-        if technology1['case'] != technology2['case']:
-            raise MismatchError
-        if technology1['title'] != technology2['title']:
+        if technology1 != technology2:
             raise MismatchError
         return True
 
+    def key_technology(self, technology):
+        try:
+            technology = self.get_canonical_technology(technology)
+        except RosettaError:
+            return
+        return technology[0]
+
+    def get_canonical_technology(self, technology):
+        'Return (case.lower(), case, title) as the technology would read back from QuickBooks'
+        def make_canonicalPack():
+            technology2 = self.parse_customer(self.format_customer(technology))
+            return technology2['case'].lower(), technology2['case'], technology2['title']
+        return get_canonicalPack(self.canonicalTechnologyByID, technology, (
+            technology['case'],
+            technology['title'],
+        ), make_canonicalPack)
+
     def get_customer_name(self, technology):
         technologyCase = technology['case']
         technologyTitle = technology['title']
@@ -94,11 +118,7 @@ class QBRosetta(object):
             raise ParseError('Could not find matching technology for technologyCase=%s' % technologyCase)
         technologyID = technology['id']
         patentTypeID = self.patentTypeByName[patentTypeName.lower()]['id'] if patentTypeName else 0
-        for country in self.countryByID.values():
-            if country['name'].lower().startswith(countryName.lower()):
-                break
-        else:
-            country = None
+        country = self.get_country_by_name(countryName)
         countryID = country['id'] if country else 0
         return {
             'technologyID': technologyID,
@@ -107,6 +127,10 @@ class QBRosetta(object):
             'countryID': countryID,
         }
 
+    def get_country_by_name(self, countryName):
+        'Return the first country in name order that starts with countryName'
+        return self.countryByNamePrefix.get(countryName.lower()) if countryName else None
+
     def format_job(self, patent, show_format_error=lambda error: None):
         technologyID = patent['technologyID']
         technology = self.technologyByID[technologyID]
@@ -117,20 +141,35 @@ class QBRosetta(object):
 
     def equal_patent(self, patent1, patent2):
         try:
-            patent1 = self.parse_job(self.format_job(patent1))
-            patent2 = self.parse_job(self.format_job(patent2))
+            patent1 = self.get_canonical_patent(patent1)
+            patent2 = self.get_canonical_patent(patent2)
         except RosettaError:
             return False
-        if patent1['serial'].lower() != patent2['serial'].lower():
+        if patent1[:2] != patent2[:2]:
             return False
-        if patent1['countryID'] != patent2['countryID']:
-            return False
-        if patent1['technologyID'] != patent2['technologyID']:
-            raise MismatchError
-        if patent1['typeID'] != patent2['typeID']:
+        if patent1 != patent2:
             raise MismatchError
         return True
 
+    def key_patent(self, patent):
+        try:
+            patent = self.get_canonical_patent(patent)
+        except RosettaError:
+            return
+        return patent[:2]
+
+    def get_canonical_patent(self, patent):
+        'Return (serial.lower(), countryID, technologyID, typeID) as the patent would read back from QuickBooks'
+        def make_canonicalPack():
+            patent2 = self.parse_job(self.format_job(patent))
+            return patent2['serial'].lower(), patent2['countryID'], patent2['technologyID'], patent2['typeID']
+        return get_canonicalPack(self.canonicalPatentByID, patent, (
+            patent['technologyID'],
+            patent['typeID'],
+            patent['serial'],
+            patent['countryID'],
+        ), make_canonicalPack)
+
     def get_job_name(self, patent):
         patentTypeID = patent['typeID']
         patentTypeName = self.patentTypeByID[patentTypeID]['name'] if patentTypeID else ''
@@ -148,16 +187,24 @@ class QBRosetta(object):
         return {'Name': lawFirm['name'][:QUICKBOOKS_VENDOR_NAME_LEN_MAX]}
 
     def equal_lawFirm(self, lawFirm1, lawFirm2):
-        vendor1 = self.format_vendor(lawFirm1)
-        vendor2 = self.format_vendor(lawFirm2)
-        lawFirm1 = self.parse_vendor(vendor1)
-        lawFirm2 = self.parse_vendor(vendor2)
-        if lawFirm1['name'].lower() != lawFirm2['name'].lower():
+        lawFirm1 = self.get_canonical_lawFirm(lawFirm1)
+        lawFirm2 = self.get_canonical_lawFirm(lawFirm2)
+        if lawFirm1[0] != lawFirm2[0]:
             return False
-        if lawFirm1['name'] != lawFirm2['name']:
+        if lawFirm1 != lawFirm2:
             raise MismatchError
         return True
 
+    def key_lawFirm(self, lawFirm):
+        return self.get_canonical_lawFirm(lawFirm)[0]
+
+    def get_canonical_lawFirm(self, lawFirm):
+        'Return (name.lower(), name) as the lawFirm would read back from QuickBooks'
+        def make_canonicalPack():
+            name = self.parse_vendor(self.format_vendor(lawFirm))['name']
+            return name.lower(), name
+        return get_canonicalPack(self.canonicalLawFirmByID, lawFirm, (lawFirm['name'],), make_canonicalPack)
+
     # Bill
 
     def parse_bill(self, bill):
@@ -167,16 +214,19 @@ class QBRosetta(object):
         except KeyError:
             raise ParseError('Could not parse lawFirmName=%s' % lawFirmName)
         lawFirmID = lawFirm['id']
-        invoiceDate = datetime.datetime.strptime(bill['TxnDate'], '%Y-%m-%d').date()
+        invoiceDate = bill['TxnDate']
         lawFirmExpenses = []
-        if hasattr(bill['ExpenseLineRet'], 'iteritems'):
-            bill['ExpenseLineRet'] = [bill['ExpenseLineRet']]
         for expenseLine in bill['ExpenseLineRet']:
+            memo = expenseLine['Memo']
+            invoiceNumber, lawFirmCase, description = self.parse_memo(memo)
             lawFirmExpenses.append({
                 'lawFirmID': lawFirmID,
                 'invoiceDate': invoiceDate,
                 'invoiceAmount': expenseLine['Amount'],
-                'memo': expenseLine['Memo'],
+                'memo': memo,
+                'invoiceNumber': invoiceNumber,
+                'lawFirmCase': lawFirmCase,
+                'description': description,
                 'TxnLineID': expenseLine['TxnLineID'],
             })
         return {
@@ -185,17 +235,21 @@ class QBRosetta(object):
             'invoiceDate': invoiceDate,
         }
 
-    def update_bill(self, lawFirmExpense1, show_format_error):
-        txnLineID = lawFirmExpense1['TxnLineID']
+    def update_bill(self, lawFirmBill, show_format_error):
+        'Format a BillMod that replaces the mismatched lines of a bill collapsed by collapse_mismatches'
+        lawFirmExpenseByTxnLineID = dict((x['TxnLineID'], x) for x in lawFirmBill['lawFirmExpenses'])
         expenseLines = []
-        for lawFirmExpense2 in self.parse_bill(lawFirmExpense1['Bill'])['lawFirmExpenses']:
-            if lawFirmExpense2['TxnLineID'] != txnLineID:
-                expenseLine = self.format_expense(lawFirmExpense2, show_format_error, withTxnLineID=True)
+        # QuickBooks deletes the lines that a BillMod leaves out, so keep the other lines, including those entered by hand, by their TxnLineID alone
+        for expenseLine in lawFirmBill['Bill']['ExpenseLineRet']:
+            txnLineID = expenseLine['TxnLineID']
+            try:
+                lawFirmExpense = lawFirmExpenseByTxnLineID[txnLineID]
+            except KeyError:
+                expenseLines.append({'TxnLineID': txnLineID})
             else:
-                expenseLine = self.format_expense(lawFirmExpense1, show_format_error, withTxnLineID=True)
-            expenseLines.append(expenseLine)
+                expenseLines.append(self.format_expense(lawFirmExpense, show_format_error, withTxnLineID=True))
         return OrderedDict([
-            ('TxnDate', lawFirmExpense1['invoiceDate'].strftime('%Y-%m-%d')),
+            ('TxnDate', lawFirmBill['invoiceDate'].strftime('%Y-%m-%d')),
             ('ExpenseLineMod', expenseLines),
         ])
 
@@ -212,22 +266,15 @@ class QBRosetta(object):
         # Format memo
         if 'memo' in lawFirmExpense:
             memo = lawFirmExpense['memo']
-            try:
-                invoiceNumber, lawFirmCase, description = self.pattern_memo.match(memo).groups()
-            except AttributeError:
+            if lawFirmExpense['invoiceNumber'] is None:
                 # Force update
                 return {}
-            lawFirmExpense.update({
-                'invoiceNumber': invoiceNumber,
-                'lawFirmCase': lawFirmCase,
-                'description': description,
-            })
         else:
             memo = 'Inv %s Ref %s    %s' % (lawFirmExpense['invoiceNumber'], lawFirmExpense['lawFirmCase'], lawFirmExpense['description'])
         # Build expenseLine
         expenseLineParts = [
             ('AccountRef', {'FullName': '6100 - Patent Related Expenses'}),
-            ('Amount', '%.02f' % float(lawFirmExpense['invoiceAmount'])),
+            ('Amount', '%.02f' % lawFirmExpense['invoiceAmount']),
             ('Memo', memo[:QUICKBOOKS_MEMO_LEN_MAX]),
         ]
         # Add link to patent
@@ -247,9 +294,12 @@ class QBRosetta(object):
         return OrderedDict(expenseLineParts)
 
     def equal_expense(self, lawFirmExpense1, lawFirmExpense2):
-        if lawFirmExpense1['lawFirmID'] != lawFirmExpense2['lawFirmID']:
-            return False
-        if lawFirmExpense1['invoiceNumber'].lower() not in lawFirmExpense2['memo'].lower():
+        if lawFirmExpense2['invoiceNumber'] is None:
+            # Match a line whose memo is not ours by finding the invoice number anywhere in its memo, then force an update
+            invoiceNumber = lawFirmExpense1['invoiceNumber'].strip().lower()
+            if lawFirmExpense1['lawFirmID'] != lawFirmExpense2['lawFirmID'] or not invoiceNumber or invoiceNumber not in (lawFirmExpense2['memo'] or '').lower():
+                return False
+        elif self.key_expense(lawFirmExpense1) != self.key_expense(lawFirmExpense2):
             return False
         lawFirmExpense1['TxnLineID'] = lawFirmExpense2['TxnLineID']
         lawFirmExpense1['Bill'] = lawFirmExpense2['Bill']
@@ -259,6 +309,18 @@ class QBRosetta(object):
             raise MismatchError
         return True
 
+    def key_expense(self, lawFirmExpense):
+        # QuickBooks expenses have an invoiceNumber of None if their memo could not be parsed, so equal_expense compares them with every expense
+        invoiceNumber = lawFirmExpense['invoiceNumber']
+        if not invoiceNumber:
+            return
+        return lawFirmExpense['lawFirmID'], invoiceNumber.strip().lower()
+
+    def parse_memo(self, memo):
+        'Return (invoiceNumber, lawFirmCase, description) or (None, None, None) if memo is not ours'
+        match = self.pattern_memo.match(memo or '')
+        return match.groups() if match else (None, None, None)
+
     def expand_bills(self, lawFirmBills):
         lawFirmExpenses = []
         for lawFirmBill in lawFirmBills:
@@ -267,6 +329,24 @@ class QBRosetta(object):
                 lawFirmExpenses.append(lawFirmExpense)
         return lawFirmExpenses
 
+    def collapse_mismatches(self, mismatches):
+        'Group mismatched expenses by the bill they are on so that each bill is modified once'
+        mismatchesByTxnID = OrderedDict()
+        for lawFirmExpense, oldLawFirmExpense in mismatches:
+            mismatchesByTxnID.setdefault(oldLawFirmExpense['Bill']['TxnID'], []).append((lawFirmExpense, oldLawFirmExpense))
+        billMismatches = []
+        for expenseMismatches in mismatchesByTxnID.itervalues():
+            lawFirmExpense, oldLawFirmExpense = expenseMismatches[0]
+            lawFirmBill = {
+                'lawFirmID': lawFirmExpense['lawFirmID'],
+                'lawFirmExpenses': [x for x, y in expenseMismatches],
+                'invoiceDate': lawFirmExpense['invoiceDate'],
+                'Bill': oldLawFirmExpense['Bill'],
+            }
+            # The first old expense carries the raw bill with its TxnID and EditSequence
+            billMismatches.append((lawFirmBill, oldLawFirmExpense))
+        return billMismatches
+
     def collapse_expenses(self, lawFirmExpenses):
         lawFirmExpensesDictionary = defaultdict(list)
         for lawFirmExpense in lawFirmExpenses:
@@ -287,6 +367,21 @@ class RosettaError(Exception):
     pass
 
 
+def get_canonicalPack(canonicalPackByID, record, fields, make_canonicalPack):
+    'Return the cached canonicalPack for record unless the fields it was made from have changed'
+    recordID = id(record)
+    try:
+        oldFields, canonicalPack = canonicalPackByID[recordID]
+    except KeyError:
+        pass
+    else:
+        if oldFields == fields:
+            return canonicalPack
+    canonicalPack = make_canonicalPack()
+    canonicalPackByID[recordID] = fields, canonicalPack
+    return canonicalPack
+
+
 def make_customer_name(*parts):
     customerName = QUICKBOOKS_SEPARATOR.join(x.replace(QUICKBOOKS_SEPARATOR, ' ') for x in parts)
     return customerName[:QUICKBOOKS_CUSTOMER_NAME_LEN_MAX].replace(':', '').strip()
@@ -0,0 +1,79 @@
+'Feed captured QBXML traces back through the response parsers to profile them without QuickBooks'
+import time
+import argparse
+from collections import OrderedDict
+
+from parameters import *
+from quickbooks import ParseSkip, ParseError
+from quickbooks.qbtrace import iter_trace
+from quickbooks.qbxml import iter_response, parse_batch_response
+from quickbooks.qbschema import decode_response_part
+
+
+def get_parsePacks(syncStatePath=SYNC_STATE_PATH):
+    'Return (stageName, objectType, parse_result) for each sync stage, using the Inteum tables saved by the last run'
+    from syncState import SyncState
+    from inteumI import has_sufficient_information
+    from quickbooksR import QBRosetta
+    from pipeline import get_stagePacks
+    syncState = SyncState(syncStatePath)
+    tables = []
+    for tableName in 'TECHNOL', 'PATENTS', 'PAPPTYPE', 'COMPANY', 'COUNTRY':
+        valueByKey = syncState.load_snapshot('Inteum' + tableName)
+        tables.append([valueByKey[x] for x in sorted(valueByKey)])
+    technologies, patents, patentTypes, lawFirms, countries = tables
+    patents = filter(has_sufficient_information, patents)
+    qbr = QBRosetta(technologies, patents, patentTypes, lawFirms, countries)
+    return [(x[0], x[2], x[3]['parse_result']) for x in get_stagePacks(qbr, technologies, patents, lawFirms, [])]
+
+
+def replay(paths, parsePacks=()):
+    'Parse every traced response as the session would and return counts and seconds by parser and request type'
+    statsByKey = OrderedDict()
+
+    def record(parserName, requestType, recordCount, errorCount, seconds):
+        stats = statsByKey.setdefault((parserName, requestType), dict(responseCount=0, recordCount=0, errorCount=0, seconds=0))
+        stats['responseCount'] += 1
+        stats['recordCount'] += recordCount
+        stats['errorCount'] += errorCount
+        stats['seconds'] += seconds
+
+    for path in paths:
+        for exchange in iter_trace(path):
+            requestType, response = exchange['requestType'], exchange['response']
+            # Queries are read page by page and writes are sent in batches
+            timeStart = time.time()
+            if requestType.endswith('QueryRq'):
+                parserName = 'iter_response'
+                results = list(iter_response(response, None, decode_response_part))
+            else:
+                parserName = 'parse_batch_response'
+                results = [y for x in parse_batch_response(response, decode_response_part).values() for y in x[1]]
+            record(parserName, requestType, len(results), 0, time.time() - timeStart)
+            # Match loaded objects the way each stage does before comparing them to candidates
+            for stageName, objectType, parse_result in parsePacks:
+                if requestType != objectType + 'QueryRq':
+                    continue
+                errorCount = 0
+                timeStart = time.time()
+                for result in results:
+                    try:
+                        parse_result(result)
+                    except ParseSkip:
+                        pass
+                    except ParseError:
+                        errorCount += 1
+                record('parse_result ' + stageName, requestType, len(results), errorCount, time.time() - timeStart)
+    return statsByKey
+
+
+if __name__ == '__main__':
+    argumentParser = argparse.ArgumentParser(description='Profile the QBXML parsers on traces saved with sync.py --trace')
+    argumentParser.add_argument('paths', nargs='+', help='trace files or folders of trace files')
+    argumentParser.add_argument('--rosetta', action='store_true', help='also time the parse_result callback of each stage on the Inteum tables saved by the last run')
+    arguments = argumentParser.parse_args()
+    statsByKey = replay(arguments.paths, get_parsePacks() if arguments.rosetta else ())
+    for (parserName, requestType), stats in statsByKey.items():
+        print '%s %s: %i responses, %i records, %i errors in %.3f seconds, %i records per second' % (
+            parserName, requestType, stats['responseCount'], stats['recordCount'], stats['errorCount'], stats['seconds'],
+            stats['recordCount'] / stats['seconds'] if stats['seconds'] else 0)
@@ -0,0 +1,71 @@
+'Inteum tables synchronized into the QuickBooks simulator, shared by the check scripts'
+import sys
+import datetime
+
+from quickbooks import QuickBooks
+from quickbooks.qbsim import RequestProcessor
+from quickbooksR import QBRosetta
+from pipeline import get_stagePacks
+
+
+# Memo of a line that someone added to a bill in QuickBooks
+HAND_MEMO = 'Courier, paid by phone'
+# Account of the lines on our bills
+EXPENSE_ACCOUNT = '6100 - Patent Related Expenses'
+
+
+technologies = [{'id': 1, 'case': 'T1', 'title': 'Widget'}]
+patents = [{'id': 1, 'technologyID': 1, 'typeID': 1, 'serial': '12/345,678', 'countryID': 1, 'lawFirmCase': 'LF1'}]
+patentTypes = [{'id': 1, 'name': 'Utility'}]
+lawFirms = [{'id': 1, 'name': 'Hoffmann & Baron'}]
+countries = [{'id': 1, 'name': 'United States'}]
+lawFirmExpenses = [{
+    'lawFirmID': 1,
+    'lawFirmCase': 'LF1',
+    'invoiceDate': datetime.date(2011, 10, 1),
+    'invoiceNumber': invoiceNumber,
+    'invoiceAmount': 100,
+    'description': 'Filing fees',
+} for invoiceNumber in ['INV1', 'INV2']]
+qbr = QBRosetta(technologies, patents, patentTypes, lawFirms, countries)
+qb = QuickBooks(requestProcessor=RequestProcessor())
+failures = []
+
+
+def iter_stagePacks():
+    'Yield the stages of the pipeline with errors recorded as failures'
+    for stageName, candidatePacks, objectType, callbackByKey, requestDictionary, dependencies in get_stagePacks(qbr, technologies, patents, lawFirms, lawFirmExpenses):
+        callbackByKey.update(
+            show_parse_error=failures.append,
+            show_save_error=lambda pack, error: failures.append(error))
+        yield stageName, candidatePacks, objectType, callbackByKey, requestDictionary
+
+
+def synchronize():
+    for stageName, candidatePacks, objectType, callbackByKey, requestDictionary in iter_stagePacks():
+        qb.synchronize(candidatePacks, objectType, callbackByKey, requestDictionary)
+
+
+def load_bill():
+    return qb.call('BillQueryRq', {'IncludeLineItems': 1})[0]
+
+
+def add_handLine(memo=HAND_MEMO, amount='12.00'):
+    'Add a line to the bill as someone would in QuickBooks'
+    bill = load_bill()
+    qb.call('BillModRq', {'BillMod': {
+        'TxnID': bill['TxnID'],
+        'EditSequence': bill['EditSequence'],
+        'ExpenseLineMod': [{'TxnLineID': x['TxnLineID']} for x in bill['ExpenseLineRet']] + [
+            {'TxnLineID': '-1', 'AccountRef': {'FullName': EXPENSE_ACCOUNT}, 'Amount': amount, 'Memo': memo}],
+    }})
+
+
+def load_amountByMemo():
+    return dict((x['Memo'], float(x['Amount'])) for x in load_bill()['ExpenseLineRet'])
+
+
+def exit_with_failures():
+    for failure in failures:
+        print failure
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,85 @@
+'Run the synchronization pipeline from the command line and report each stage as JSON'
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+
+from csvI import moduleByName, find_module, find_pathPacks
+from parameters import *
+from pipeline import Pipeline, make_quickbooks
+
+
+def get_pathPacks(paths, moduleName=None):
+    'Return (module, path) for each spreadsheet, expanding folders'
+    pathPacks = []
+    for path in paths:
+        if os.path.isdir(path):
+            pathPacks.extend(find_pathPacks(path))
+            continue
+        module = moduleByName[moduleName] if moduleName else find_module(os.path.basename(path))
+        if not module:
+            raise ValueError('Could not choose a law firm for %s; use --module' % path)
+        pathPacks.append((module, path))
+    return pathPacks
+
+
+def run(arguments):
+    'Run pipeline with non-interactive policies and return a dictionary of results'
+    show_text = (lambda text: None) if arguments.quiet else sys.stderr.write
+    prompt_update = lambda pack, oldPack: arguments.update == 'all'
+    prompt_save = lambda newPacks, newResults: arguments.save == 'all'
+    pipeline = Pipeline(dict(
+        show_text=show_text,
+        prompt_update=prompt_update,
+        prompt_save=prompt_save,
+        show_parse_error=lambda error: show_text('%s\n' % error),
+        show_format_error=lambda error: show_text('%s\n' % error),
+        show_save_error=lambda pack, error: show_text('Could not save %s: %s\n' % (pack, error)),
+    ))
+    resultByKey = {
+        'paths': arguments.paths,
+        'timeStart': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    timeStart = time.time()
+    try:
+        qb = make_quickbooks(arguments.offline or QUICKBOOKS_OFFLINE, arguments.trace)
+        if arguments.apply:
+            pipeline.apply_changes(arguments.apply, qb)
+        else:
+            pathPacks = get_pathPacks(arguments.paths, arguments.module)
+            pipeline.run(pathPacks, qb, arguments.dry_run, arguments.full_scan)
+    except Exception, error:
+        show_text(traceback.format_exc())
+        resultByKey['error'] = str(error)
+    resultByKey['isOk'] = 'error' not in resultByKey
+    resultByKey['seconds'] = round(time.time() - timeStart, 3)
+    resultByKey['stages'] = pipeline.stageResults
+    resultByKey['metrics'] = pipeline.metrics.get_summary() if pipeline.metrics else None
+    return resultByKey
+
+
+if __name__ == '__main__':
+    argumentParser = argparse.ArgumentParser(description='Import law firm expenses into QuickBooks and synchronize them with Inteum')
+    argumentParser.add_argument('paths', nargs='*', help='spreadsheets or folders of spreadsheets')
+    argumentParser.add_argument('--module', choices=sorted(moduleByName), help='law firm of the spreadsheets; by default chosen by file name')
+    argumentParser.add_argument('--update', choices=['all', 'none'], default='all', help='whether to update QuickBooks objects that differ')
+    argumentParser.add_argument('--save', choices=['all', 'none'], default='all', help='whether to add new QuickBooks objects')
+    argumentParser.add_argument('--offline', action='store_true', help='match against the local cache and connect to QuickBooks only to write')
+    argumentParser.add_argument('--full-scan', action='store_true', help='query every Inteum and QuickBooks record instead of those changed since the last run, to catch records that were deleted or merged')
+    argumentParser.add_argument('--dry-run', metavar='PATH', help='save planned changes to PATH as JSON Lines, or as CSV if PATH ends with .csv, instead of writing them')
+    argumentParser.add_argument('--apply', metavar='PATH', help='write the changes saved by --dry-run to QuickBooks instead of reading spreadsheets')
+    argumentParser.add_argument('--trace', metavar='FOLDER', default=QUICKBOOKS_TRACE_FOLDER, help='save every QBXML request and response to compressed files in FOLDER for replay.py')
+    argumentParser.add_argument('--json', metavar='PATH', help='write results to PATH instead of standard output')
+    argumentParser.add_argument('--quiet', action='store_true', help='do not show progress on standard error')
+    arguments = argumentParser.parse_args()
+    if bool(arguments.paths) == bool(arguments.apply):
+        argumentParser.error('give either spreadsheets or --apply')
+    resultByKey = run(arguments)
+    resultText = json.dumps(resultByKey, indent=2)
+    if arguments.json:
+        open(arguments.json, 'wt').write(resultText)
+    else:
+        print resultText
+    sys.exit(0 if resultByKey['isOk'] else 1)
@@ -0,0 +1,89 @@
+'Persist high-water marks and snapshots between synchronization runs'
+import sqlite3
+import datetime
+import cPickle as pickle
+import _strptime # Import before threads call strptime to avoid a race in its lazy import
+from threading import RLock
+
+
+class SyncState(object):
+    'Local SQLite store of per-object-type watermarks and the values loaded so far'
+
+    def __init__(self, path, fullScanInterval=datetime.timedelta(days=7)):
+        # Loaders in other threads share the connection one statement at a time
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = RLock()
+        self.connection.executescript("""\
+CREATE TABLE IF NOT EXISTS watermarks (
+    name TEXT PRIMARY KEY,
+    watermark BLOB,
+    fullScanTime TIMESTAMP);
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT,
+    key TEXT,
+    value BLOB,
+    PRIMARY KEY (name, key));""")
+        self.fullScanInterval = fullScanInterval
+
+    def refresh(self, name, get_changed, get_key, fullScan=False):
+        'Merge values changed since the last watermark into the snapshot and return every value'
+        # get_changed(fromWatermark) returns (watermark, values) and loads everything if fromWatermark is None
+        now = datetime.datetime.now()
+        oldWatermark, fullScanTime = self.load_watermark(name)
+        if fullScan or oldWatermark is None or now - fullScanTime > self.fullScanInterval:
+            fromWatermark = None
+        else:
+            fromWatermark = oldWatermark
+        newWatermark, changedValues = get_changed(fromWatermark)
+        changedValueByKey = dict((unicode(get_key(x)), x) for x in changedValues)
+        if fromWatermark is None:
+            valueByKey = changedValueByKey
+            self.save_snapshot(name, valueByKey, replace=True)
+            fullScanTime = now
+        else:
+            valueByKey = self.load_snapshot(name)
+            valueByKey.update(changedValueByKey)
+            self.save_snapshot(name, changedValueByKey)
+        self.save_watermark(name, newWatermark if newWatermark is not None else oldWatermark, fullScanTime)
+        return [valueByKey[x] for x in sorted(valueByKey)]
+
+    def has_snapshot(self, name):
+        'Return True if name has been loaded before'
+        return self.load_watermark(name)[1] is not None
+
+    def load_watermark(self, name):
+        'Return (watermark, fullScanTime) or (None, None) if name has never been loaded'
+        with self.lock:
+            row = self.connection.execute('SELECT watermark, fullScanTime FROM watermarks WHERE name = ?', (name,)).fetchone()
+        if not row:
+            return None, None
+        watermark, fullScanTime = row
+        return pickle.loads(str(watermark)), datetime.datetime.strptime(fullScanTime, '%Y-%m-%d %H:%M:%S.%f')
+
+    def save_watermark(self, name, watermark, fullScanTime):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO watermarks (name, watermark, fullScanTime) VALUES (?, ?, ?)', (
+                name,
+                sqlite3.Binary(pickle.dumps(watermark, pickle.HIGHEST_PROTOCOL)),
+                fullScanTime.strftime('%Y-%m-%d %H:%M:%S.%f')))
+
+    def load_snapshot(self, name):
+        'Return values by key'
+        with self.lock:
+            rows = self.connection.execute('SELECT key, value FROM snapshots WHERE name = ?', (name,)).fetchall()
+        valueByKey = {}
+        for key, value in rows:
+            valueByKey[key] = pickle.loads(str(value))
+        return valueByKey
+
+    def merge_snapshot(self, name, values, get_key):
+        'Store values alongside the rest of the snapshot'
+        self.save_snapshot(name, dict((unicode(get_key(x)), x) for x in values))
+
+    def save_snapshot(self, name, valueByKey, replace=False):
+        'Store values by key, replacing the whole snapshot if requested'
+        with self.lock, self.connection:
+            if replace:
+                self.connection.execute('DELETE FROM snapshots WHERE name = ?', (name,))
+            self.connection.executemany('INSERT OR REPLACE INTO snapshots (name, key, value) VALUES (?, ?, ?)', (
+                (name, key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))) for key, value in valueByKey.iteritems()))
@@ -202,10 +202,9 @@ class QBRosetta(object):
         except KeyError:
             raise ParseError('Could not parse lawFirmName=%s' % lawFirmName)
         lawFirmID = lawFirm['id']
-        invoiceDate = datetime.datetime.strptime(bill['TxnDate'], '%Y-%m-%d').date()
+        # Bill records decode TxnDate and always list ExpenseLineRet
+        invoiceDate = bill['TxnDate']
         lawFirmExpenses = []
-        if hasattr(bill['ExpenseLineRet'], 'iteritems'):
-            bill['ExpenseLineRet'] = [bill['ExpenseLineRet']]
         for expenseLine in bill['ExpenseLineRet']:
             lawFirmExpenses.append({
                 'lawFirmID': lawFirmID,
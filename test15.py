@@ -6,6 +6,8 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from quickbooks.qbcom import QuickBooks
+from inteumI import reflect_tables
+from parameters import INTEUM_METADATA_CACHE_PATH
 
 
 errors = set()
@@ -56,8 +58,7 @@ bills = qb.call('BillQueryRq', {'IncludeLineItems': 1})
 sqlalchemyURL = 'mssql+pyodbc://inteumCSdb'
 Base = declarative_base()
 engine = create_engine(sqlalchemyURL)
-Base.metadata.reflect(engine)
-tables = Base.metadata.tables
+tables = reflect_tables(engine, ['COMPANY', 'PATENTS', 'TECHNOL', 'PAYABLE', 'PAYBLDTL'], INTEUM_METADATA_CACHE_PATH)
 class Company(Base):
     __table__ = tables['COMPANY']
 class Patent(Base):
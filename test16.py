@@ -0,0 +1,36 @@
+'Check that parsing modules import quickly and without COM, database or window modules'
+import sys
+import subprocess
+
+
+# Modules that should load without heavy dependencies
+MODULE_NAMES = ['quickbooks.qbxml', 'quickbooks.qbschema', 'quickbooksR', 'csvI']
+# Modules that must not be imported by them
+FORBIDDEN_PREFIXES = ['win32com', 'pythoncom', 'pywintypes', 'sqlalchemy', 'pyodbc', 'wx']
+# Seconds allowed to import each module in a fresh interpreter
+IMPORT_SECONDS_MAX = 1
+
+
+failures = []
+for moduleName in MODULE_NAMES:
+    output = subprocess.check_output([sys.executable, '-c', """\
+import sys
+import time
+timeStart = time.time()
+import %s
+print time.time() - timeStart
+print ' '.join(sys.modules)""" % moduleName])
+    secondsText, importedNamesText = output.splitlines()
+    seconds = float(secondsText)
+    importedNames = importedNamesText.split()
+    forbiddenNames = sorted(x for x in importedNames if x.split('.')[0] in FORBIDDEN_PREFIXES)
+    print '%s: %.3f seconds, %i modules' % (moduleName, seconds, len(importedNames))
+    if forbiddenNames:
+        failures.append('%s imports %s' % (moduleName, ', '.join(forbiddenNames)))
+    if seconds > IMPORT_SECONDS_MAX:
+        failures.append('%s takes %.3f seconds to import' % (moduleName, seconds))
+
+
+for failure in failures:
+    print failure
+sys.exit(1 if failures else 0)
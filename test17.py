@@ -0,0 +1,18 @@
+'Check that updating an expense through the QuickBooks simulator keeps the other lines of its bill, including lines entered by hand'
+from simulatorFixture import *
+
+
+synchronize()
+add_handLine()
+lawFirmExpenses[0]['invoiceAmount'] = 150
+synchronize()
+amountByMemo = load_amountByMemo()
+if len(amountByMemo) != 3:
+    failures.append('The bill has %i lines instead of 3' % len(amountByMemo))
+if amountByMemo.get(HAND_MEMO) != 12:
+    failures.append('The line entered by hand was changed or deleted')
+if amountByMemo.get('Inv INV1 Ref LF1    Filing fees') != 150:
+    failures.append('The mismatched line was not updated')
+if amountByMemo.get('Inv INV2 Ref LF1    Filing fees') != 100:
+    failures.append('The matching line was changed or deleted')
+exit_with_failures()
@@ -0,0 +1,44 @@
+'Check that a Mod refused for an out-of-date EditSequence is planned again from the current object instead of overwriting the other edit'
+from collections import OrderedDict
+
+from simulatorFixture import *
+
+
+def plan_stage(stageName):
+    'Return the SyncPlan of a stage after sending any Mods it needs'
+    for stageName2, candidatePacks, objectType, callbackByKey, requestDictionary in iter_stagePacks():
+        syncPlan = qb.plan(candidatePacks, objectType, callbackByKey, requestDictionary)
+        if stageName2 == stageName:
+            return syncPlan
+        qb.apply(syncPlan)
+
+
+def load_customer():
+    return [x for x in qb.call('CustomerQueryRq') if not x.get('ParentRef')][0]
+
+
+plan_stage(None)
+# Someone adds a line to the bill after we loaded it
+lawFirmExpenses[0]['invoiceAmount'] = 150
+syncPlan = plan_stage('expenses')
+add_handLine()
+qb.apply(syncPlan)
+amountByMemo = load_amountByMemo()
+if amountByMemo.get(HAND_MEMO) != 12:
+    failures.append('The line added during the synchronization was changed or deleted')
+if amountByMemo.get('Inv INV1 Ref LF1    Filing fees') != 150:
+    failures.append('The mismatched line was not updated')
+# Someone renames the customer as we would after we loaded it
+technologies[0]['title'] = 'Gadget'
+syncPlan = plan_stage('customers')
+customer = load_customer()
+qb.call('CustomerModRq', {'CustomerMod': OrderedDict([
+    ('ListID', customer['ListID']),
+    ('EditSequence', customer['EditSequence']),
+    ('Name', 'T1 - Gadget'),
+])})
+editSequence = load_customer()['EditSequence']
+qb.apply(syncPlan)
+if load_customer()['EditSequence'] != editSequence:
+    failures.append('The customer was modified again although it already matched')
+exit_with_failures()
@@ -0,0 +1,36 @@
+'Check that QBXML responses with characters beyond ASCII parse, because COM returns them as unicode'
+from quickbooks.qbxml import iter_response, parse_batch_response
+from simulatorFixture import *
+
+
+# Memo of a line that someone typed by hand with accents
+ACCENTED_MEMO = u'Coursier, pay\xe9 par t\xe9l\xe9phone'
+RESPONSE = u'<?xml version="1.0" ?><QBXML><QBXMLMsgsRs><BillModRs requestID="1" statusCode="0" statusSeverity="Info" statusMessage="Status OK"><BillRet><ExpenseLineRet><Memo>%s</Memo></ExpenseLineRet></BillRet></BillModRs></QBXMLMsgsRs></QBXML>' % ACCENTED_MEMO
+
+
+def check_parse(parserName, parse):
+    try:
+        memo = parse(RESPONSE)
+    except UnicodeError, error:
+        failures.append('%s could not parse a unicode response: %s' % (parserName, error))
+        return
+    if memo != ACCENTED_MEMO:
+        failures.append('%s returned the memo %r' % (parserName, memo))
+
+
+check_parse('parse_batch_response', lambda x: parse_batch_response(x)['1'][1][0]['ExpenseLineRet']['Memo'])
+check_parse('iter_response', lambda x: list(iter_response(x))[0]['ExpenseLineRet']['Memo'])
+# QuickBooks echoes the line typed by hand in the BillModRs of our next update
+synchronize()
+add_handLine(ACCENTED_MEMO)
+lawFirmExpenses[0]['invoiceAmount'] = 150
+try:
+    synchronize()
+except UnicodeError, error:
+    failures.append('Could not parse the response to our update: %s' % error)
+amountByMemo = load_amountByMemo()
+if amountByMemo.get(ACCENTED_MEMO) != 12:
+    failures.append('The line typed by hand was changed or deleted')
+if amountByMemo.get('Inv INV1 Ref LF1    Filing fees') != 150:
+    failures.append('The mismatched line was not updated')
+exit_with_failures()
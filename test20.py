@@ -0,0 +1,65 @@
+'Check that LEDES files load with pipe, tab and comma delimiters, whether or not the rows of each invoice are grouped together, and that overlapping files load each invoice once'
+import os
+import shutil
+import tempfile
+
+from csvI import HoffmannAndBaron, drop_repeated_invoices, find_pathPacks, load_folder
+from simulatorFixture import technologies, patents, patentTypes, lawFirms, countries, failures, exit_with_failures
+
+
+COLUMN_NAMES = ['INVOICE_DATE', 'INVOICE_NUMBER', 'INVOICE_AMOUNT', 'LAW_FIRM_REFERENCE_NUMBER', 'DESCRIPTION_OF_EXPENSES']
+GROUPED_ROWS = [
+    ('INV1', 'Filing'),
+    ('INV1', 'Filing fees'),
+    ('INV2', 'Search'),
+]
+UNGROUPED_ROWS = [
+    ('INV1', 'Filing'),
+    ('INV2', 'Search'),
+    ('INV1', 'Filing fees'),
+]
+
+
+def write_file(fileName, rows, delimiter):
+    'Write rows in the layout that law firms send for each delimiter'
+    lines = [delimiter.join(COLUMN_NAMES)] + [delimiter.join(['20111001', invoiceNumber, '100.00', 'OUR DOCKET: LF1 (X)', description]) for invoiceNumber, description in rows]
+    if delimiter == '|':
+        lines = ['LEDES1998B[]'] + [x + '[]' for x in lines]
+    elif delimiter == '\t':
+        lines = ['LEDES1998B'] + lines
+    path = os.path.join(folderPath, fileName)
+    open(path, 'w').write('\n'.join(lines) + '\n')
+    return path
+
+
+def check_expenses(name, lawFirmExpenses, expectedPacks):
+    packs = sorted((x['invoiceNumber'], x['description']) for x in lawFirmExpenses)
+    if packs != expectedPacks:
+        failures.append('%s: loaded %s instead of %s' % (name, packs, expectedPacks))
+    for lawFirmExpense in lawFirmExpenses:
+        if (lawFirmExpense['lawFirmCase'], str(lawFirmExpense['invoiceDate']), lawFirmExpense['invoiceAmount']) != ('LF1', '2011-10-01', 100):
+            failures.append('%s: loaded %s' % (name, lawFirmExpense))
+
+
+qbr = HoffmannAndBaron(technologies, patents, patentTypes, lawFirms, countries)
+folderPath = tempfile.mkdtemp()
+try:
+    for delimiterName, delimiter in [('pipe', '|'), ('tab', '\t'), ('comma', ',')]:
+        for orderName, rows in [('grouped', GROUPED_ROWS), ('ungrouped', UNGROUPED_ROWS)]:
+            path = write_file('%s-%s.txt' % (delimiterName, orderName), rows, delimiter)
+            check_expenses('%s %s' % (orderName, delimiterName), list(qbr.load_expenses(path)), [('INV1', 'Filing fees'), ('INV2', 'Search')])
+    # A row that arrives after its invoice was yielded must not load the invoice twice
+    path = write_file('late.txt', UNGROUPED_ROWS, '|')
+    check_expenses('late row', list(drop_repeated_invoices(qbr.load_expenses(path, pendingInvoiceCountMax=1))), [('INV1', 'Filing'), ('INV2', 'Search')])
+    check_expenses('empty file', list(qbr.load_expenses(write_file('empty.txt', [], '|'))), [])
+    # Overlapping exports load each invoice from the first file in the folder, in parallel or not
+    shutil.rmtree(folderPath)
+    folderPath = tempfile.mkdtemp()
+    write_file('hoffmann-1.txt', [('INV1', 'Filing fees'), ('INV2', 'Search')], '|')
+    write_file('hoffmann-2.txt', [('INV2', 'Search again'), ('INV3', 'Drawings')], '\t')
+    inteumTables = technologies, patents, patentTypes, lawFirms, countries
+    for processCount in 1, 2:
+        check_expenses('overlapping files in %i processes' % processCount, list(load_folder(find_pathPacks(folderPath), inteumTables, processCount)), [('INV1', 'Filing fees'), ('INV2', 'Search'), ('INV3', 'Drawings')])
+finally:
+    shutil.rmtree(folderPath)
+exit_with_failures()